@@ -0,0 +1,78 @@
+"""Throughput of `Broadcast` to verified students of one group.
+
+Adds `--users` verified students to the students database from
+`data/Scheduler/stud_db_config.json` and broadcasts to them through the fake
+Bot API, which enforces Telegram's flood limits. With `--interrupt-after` the
+first run is cancelled and the broadcast resumed, every student should still
+get exactly one message. Run from the repository root:
+
+    python -m benchmarks.broadcast_throughput --users 2000 --interrupt-after 10
+"""
+import argparse
+import asyncio
+import logging
+import tempfile
+from collections import Counter
+from types import SimpleNamespace
+
+from telegram import Bot
+from telegram.request import HTTPXRequest
+
+from benchmarks.fake_bot_api import serve
+from benchmarks.student_db_latency import FIRST_ID
+from outbound import OutboundScheduler
+from services.StudentBot import Broadcast, StudentDB
+
+GROUP = "bench"
+
+
+async def main(port: int, users: int, interrupt_after: float | None) -> None:
+    server, api = serve(port)
+    logger = logging.getLogger("broadcast_throughput")
+    student_db = StudentDB()
+    await student_db.open()
+
+    async with Bot("1:fake", base_url=f"http://localhost:{port}/bot", request=HTTPXRequest(256)) as bot:
+        service = SimpleNamespace(logger=logger, student_db=student_db, schedule_db=None,
+                                  outbound=OutboundScheduler(logger), app=SimpleNamespace(bot=bot))
+        outbound = asyncio.create_task(service.outbound.run())
+        broadcast = Broadcast(service)
+        broadcast.CHECKPOINTS = tempfile.mktemp(suffix=".json")
+
+        try:
+            async with student_db.pool.connection() as connection:
+                await connection.execute(
+                    """INSERT INTO students (id, verified, "group") SELECT id, true, %s FROM generate_series(%s, %s) AS id""",
+                    (GROUP, FIRST_ID, FIRST_ID + users - 1))
+
+            if interrupt_after is not None:
+                try:
+                    async with asyncio.timeout(interrupt_after):
+                        await broadcast.broadcast("bench", GROUP, "Schedule")
+                except TimeoutError:
+                    print(f"Interrupted after {len(api.sent)} messages")
+
+            report = await broadcast.broadcast("bench", GROUP, "Schedule")
+            print(f"Broadcast: {report.sent} sent, {report.failed} failed in {report.seconds:.1f}s, "
+                  f"{report.rate:.1f} msg/s")
+
+            per_chat = Counter(chat_id for _, _, chat_id in api.sent)
+            duplicates = sum(count - 1 for count in per_chat.values())
+            print(f"{len(per_chat)}/{users} students reached, {duplicates} duplicate messages, "
+                  f"{api.calls['429']} flood limited responses")
+
+        finally:
+            outbound.cancel()
+            async with student_db.pool.connection() as connection:
+                await connection.execute("DELETE FROM students WHERE id >= %s", (FIRST_ID,))
+            await student_db.close()
+            server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8082)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--interrupt-after", type=float)
+    args = parser.parse_args()
+    asyncio.run(main(args.port, args.users, args.interrupt_after))
@@ -0,0 +1,213 @@
+"""Local fake of the Telegram Bot API.
+
+Answers the methods the bots use, enforces flood limits the way Telegram
+does (429 with `retry_after`) and records every call, so sending can be
+measured without touching Telegram. Point a bot at it with
+`ApplicationBuilder().base_url("http://localhost:8082/bot")`. Run from the
+repository root:
+
+    python -m benchmarks.fake_bot_api --port 8082
+"""
+import argparse
+import json
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic, sleep, time
+from urllib.parse import parse_qsl, urlparse
+
+from outbound import TokenBucket
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Fake bot", "username": "fake_bot"}
+# Methods sending something to a chat, only these are flood limited
+SENDING_METHODS = {"sendMessage", "editMessageText", "deleteMessage"}
+
+
+def fake_user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"User {user_id}", "username": f"user{user_id}"}
+
+
+def fake_chat(chat_id: int) -> dict:
+    if chat_id > 0:
+        return {"id": chat_id, "type": "private", "first_name": f"User {chat_id}"}
+    return {"id": chat_id, "type": "group", "title": f"Group {chat_id}"}
+
+
+def message_update(user_id: int, text: str, message_id: int = 1, update_id: int = 1) -> dict:
+    "Update with a private text message, commands get their entity like Telegram sends them"
+    message = {"message_id": message_id, "date": int(time()), "chat": fake_chat(user_id),
+               "from": fake_user(user_id), "text": text}
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+
+def callback_update(user_id: int, data: str, message_id: int = 1, update_id: int = 1, text: str = "") -> dict:
+    "Update with a press of an inline button under the bot's message `message_id` saying `text`"
+    return {"update_id": update_id, "callback_query": {
+        "id": f"{user_id}{message_id}", "from": fake_user(user_id), "chat_instance": str(user_id), "data": data,
+        "message": {"message_id": message_id, "date": int(time()), "chat": fake_chat(user_id), "from": BOT_USER, "text": text},
+    }}
+
+
+class FakeBotAPI:
+    "State shared by request handler threads"
+    def __init__(self, global_rate: float = 30, chat_rate: float = 1, chat_burst: float = 3,
+                 enforce_limits: bool = True, retry_after: int = 1) -> None:
+        self.lock = threading.Lock()
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.enforce_limits = enforce_limits
+        self.retry_after = retry_after
+
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_buckets: dict[int, TokenBucket] = {}
+        self.message_id = 0
+        # Method: calls, "429" counts flood limited ones
+        self.calls = Counter()
+        # (monotonic time, method, chat id) of every successful sending call
+        self.sent: list[tuple[float, str, int]] = []
+        # Callbacks of `on_send`, called with the same tuple
+        self.send_listeners = []
+
+        self.updates: list[dict] = []
+        self.update_id = 0
+        self.updates_changed = threading.Condition(self.lock)
+
+    def push_update(self, update: dict) -> None:
+        "Queues an update for getUpdates, `update_id` is filled in"
+        with self.updates_changed:
+            self.update_id += 1
+            self.updates.append({**update, "update_id": self.update_id})
+            self.updates_changed.notify_all()
+
+    def on_send(self, listener) -> None:
+        self.send_listeners.append(listener)
+
+    def _flood_limited(self, chat_id: int, now: float) -> bool:
+        if not self.enforce_limits:
+            return False
+
+        bucket = self.chat_buckets.setdefault(chat_id, TokenBucket(self.chat_rate, self.chat_burst))
+        if bucket.delay(now) > 0 or self.global_bucket.delay(now) > 0:
+            return True
+
+        bucket.consume(now)
+        self.global_bucket.consume(now)
+        return False
+
+    def handle(self, method: str, params: dict) -> tuple[int, dict]:
+        chat_id = int(params.get("chat_id", 0))
+
+        with self.lock:
+            self.calls[method] += 1
+            now = monotonic()
+
+            if method in SENDING_METHODS:
+                if self._flood_limited(chat_id, now):
+                    self.calls["429"] += 1
+                    return 429, {"ok": False, "error_code": 429,
+                                 "description": f"Too Many Requests: retry after {self.retry_after}",
+                                 "parameters": {"retry_after": self.retry_after}}
+                self.sent.append((now, method, chat_id))
+
+            if method == "sendMessage":
+                self.message_id += 1
+                message_id = self.message_id
+            else:
+                message_id = int(params.get("message_id", 0))
+
+        if method in SENDING_METHODS:
+            for listener in self.send_listeners:
+                listener((now, method, chat_id))
+
+        if method in ("sendMessage", "editMessageText"):
+            return 200, {"ok": True, "result": {
+                "message_id": message_id, "date": int(time()), "chat": fake_chat(chat_id),
+                "from": BOT_USER, "text": params.get("text", ""),
+            }}
+        if method == "getMe":
+            return 200, {"ok": True, "result": BOT_USER}
+        if method == "getChatMember":
+            return 200, {"ok": True, "result": {"status": "member", "user": fake_user(int(params["user_id"]))}}
+        if method == "getChatMemberCount":
+            return 200, {"ok": True, "result": 2}
+        if method == "getUpdates":
+            return 200, {"ok": True, "result": self.get_updates(int(params.get("offset", 0)), float(params.get("timeout", 0)))}
+        if method == "getWebhookInfo":
+            return 200, {"ok": True, "result": {"url": "", "has_custom_certificate": False, "pending_update_count": 0}}
+
+        # deleteMessage, answerCallbackQuery, setMyCommands, setWebhook, deleteWebhook...
+        return 200, {"ok": True, "result": True}
+
+    def get_updates(self, offset: int, timeout: float) -> list[dict]:
+        with self.updates_changed:
+            # Confirmed updates are dropped, like Telegram does
+            self.updates = [update for update in self.updates if update["update_id"] >= offset]
+            if not self.updates:
+                self.updates_changed.wait(timeout)
+            return list(self.updates)
+
+
+def parse_params(content_type: str, body: bytes) -> dict:
+    "PTB sends url-encoded forms with JSON encoded values, JSON bodies are accepted too"
+    if not body:
+        return {}
+    if content_type.startswith("application/json"):
+        return json.loads(body)
+    return dict(parse_qsl(body.decode()))
+
+
+def make_handler(api: FakeBotAPI):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self) -> None:
+            # /bot<token>/<method>
+            method = urlparse(self.path).path.rsplit("/", 1)[-1]
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            status, response = api.handle(method, parse_params(self.headers.get("Content-Type", ""), body))
+
+            data = json.dumps(response).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        do_GET = do_POST
+
+        def log_message(self, format, *args) -> None:
+            pass
+
+    return Handler
+
+
+def serve(port: int, api: FakeBotAPI | None = None) -> tuple[ThreadingHTTPServer, FakeBotAPI]:
+    "Starts the server in a daemon thread"
+    api = api or FakeBotAPI()
+    server = ThreadingHTTPServer(("localhost", port), make_handler(api))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, api
+
+
+def main(port: int, enforce_limits: bool) -> None:
+    server, api = serve(port, FakeBotAPI(enforce_limits=enforce_limits))
+    print(f"Fake Bot API on http://localhost:{port}/bot")
+
+    try:
+        while True:
+            sleep(10)
+            print(dict(api.calls))
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8082)
+    parser.add_argument("--no-limits", action="store_true", help="never answer with 429")
+    args = parser.parse_args()
+    main(args.port, not args.no_limits)
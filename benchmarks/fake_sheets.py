@@ -0,0 +1,130 @@
+"""Local fake of the Google Sheets values and Drive files endpoints.
+
+Serves synthetic schedule ranges for `ScheduleDataFetcherService` so change
+detection and polling can be tried offline. Point the fetcher at it with
+`data/Scheduler/fetcher_config.json`:
+
+    {"sheets_api_url": "http://localhost:8081", "drive_api_url": "http://localhost:8081",
+     "credentials_file": null}
+
+and run from the repository root:
+
+    python -m benchmarks.fake_sheets --port 8081 --edit-every 120
+"""
+import argparse
+import json
+import random
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep
+from urllib.parse import parse_qs, urlparse
+
+DAYS = ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday")
+TIMES = ("8:30", "10:25", "12:20", "14:15", "16:10", "18:30")
+
+
+def synthetic_range(group_number: int, week: int) -> list[list[str]]:
+    "Value range shaped like a group's week in the spreadsheet"
+    data = []
+    for day in DAYS:
+        data.append([day])
+        for slot, time in enumerate(TIMES):
+            subject = f"Subject {(group_number + slot + week) % 17}"
+            url = f"https://meet.example.com/{group_number}-{week}-{day[:3]}-{slot}"
+            data.append(["", time, subject, "Lecture" if slot % 2 else "Practice", url])
+    return data
+
+
+class FakeSheets:
+    "Spreadsheet state shared by request handler threads"
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.version = 1
+        # Range: values
+        self.values: dict[str, list[list[str]]] = {}
+        self.requests = Counter()
+
+    def get_range(self, range_: str) -> list[list[str]]:
+        with self.lock:
+            if range_ not in self.values:
+                # "KM31!A3:E32" is the first week of a group, "KM31!G3:K32" the second
+                sheet, cells = range_.split("!")
+                week = 1 if cells.startswith("A") else 2
+                self.values[range_] = synthetic_range(sum(map(ord, sheet)), week)
+            return self.values[range_]
+
+    def edit(self) -> str:
+        "Changes a subject in a random known range, returns the range"
+        with self.lock:
+            range_ = random.choice(list(self.values))
+            rows = [row for row in self.values[range_] if len(row) == 5]
+            random.choice(rows)[2] = f"Edited subject {self.version}"
+            self.version += 1
+            return range_
+
+
+def make_handler(sheets: FakeSheets):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            url = urlparse(self.path)
+
+            if url.path.startswith("/drive/v3/files/"):
+                sheets.requests["version"] += 1
+                self.send_json({"version": str(sheets.version), "modifiedTime": "2024-01-01T00:00:00.000Z"})
+
+            elif url.path.endswith("/values:batchGet"):
+                sheets.requests["batchGet"] += 1
+                ranges = parse_qs(url.query).get("ranges", [])
+                self.send_json({"valueRanges": [
+                    {"range": range_, "majorDimension": "ROWS", "values": sheets.get_range(range_)}
+                    for range_ in ranges
+                ]})
+
+            elif url.path == "/stats":
+                self.send_json({"version": sheets.version, "requests": sheets.requests})
+
+            else:
+                self.send_json({"error": {"code": 404, "message": "Not found"}}, status=404)
+
+        def send_json(self, data: dict, status: int = 200) -> None:
+            body = json.dumps(data).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args) -> None:
+            pass
+
+    return Handler
+
+
+def serve(port: int, sheets: FakeSheets | None = None) -> tuple[ThreadingHTTPServer, FakeSheets]:
+    "Starts the server in a daemon thread"
+    sheets = sheets or FakeSheets()
+    server = ThreadingHTTPServer(("localhost", port), make_handler(sheets))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, sheets
+
+
+def main(port: int, edit_every: float) -> None:
+    server, sheets = serve(port)
+    print(f"Fake Sheets API on http://localhost:{port}")
+
+    try:
+        while True:
+            sleep(edit_every)
+            if sheets.values:
+                print(f"Edited {sheets.edit()}, version {sheets.version}, requests {dict(sheets.requests)}")
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--edit-every", type=float, default=120, help="seconds between simulated edits")
+    args = parser.parse_args()
+    main(args.port, args.edit_every)
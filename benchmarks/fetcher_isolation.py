@@ -0,0 +1,93 @@
+"""Event loop lag of the bot while schedules are ingested.
+
+Ingestion writes `--groups` groups x 2 weeks into temporary tables of the
+schedule database like `benchmarks.schedule_ingest`, over and over. It runs
+either as a task on the bot's event loop, as ScheduleDataFetcherService would
+next to StudentBotService in `Main.async_run`, or in a `WorkerProcess`.
+Meanwhile the loop wakes up every millisecond and records how late it is, the
+delay every update handled at that moment would get. Run from the repository root:
+
+    python -m benchmarks.fetcher_isolation --groups 50 --seconds 10
+"""
+import argparse
+import asyncio
+import logging
+from functools import partial
+from time import perf_counter
+
+import psycopg2
+
+from benchmarks.outbound_burst import percentile
+from benchmarks.schedule_ingest import run_mode
+from services.StudentBot import load_schedule_db, split_db_config
+from workers import WorkerProcess
+
+TICK = 0.001
+GROUPS = 50
+
+
+def ingest_forever(logger: logging.Logger, groups: int) -> None:
+    connection = psycopg2.connect(**split_db_config(load_schedule_db())[0])
+    try:
+        while True:
+            run_mode(connection, "values", groups)
+    finally:
+        connection.close()
+
+
+async def ingest_task(groups: int) -> None:
+    connection = psycopg2.connect(**split_db_config(load_schedule_db())[0])
+    try:
+        while True:
+            run_mode(connection, "values", groups)
+            await asyncio.sleep(0)
+    finally:
+        connection.close()
+
+
+async def measure_lag(seconds: float) -> list[float]:
+    "Milliseconds each wake-up came late"
+    lags = []
+    end = perf_counter() + seconds
+    while perf_counter() < end:
+        start = perf_counter()
+        await asyncio.sleep(TICK)
+        lags.append((perf_counter() - start - TICK) * 1000)
+    return lags
+
+
+async def run(mode: str, groups: int, seconds: float) -> list[float]:
+    if mode == "none":
+        return await measure_lag(seconds)
+
+    if mode == "task":
+        ingestion = asyncio.create_task(ingest_task(groups))
+    else:
+        worker = WorkerProcess("ingest", partial(ingest_forever, groups=groups), logging.getLogger())
+        ingestion = asyncio.create_task(worker.run())
+        # Process is up and ingesting
+        await asyncio.sleep(2)
+
+    try:
+        return await measure_lag(seconds)
+    finally:
+        ingestion.cancel()
+        try:
+            await ingestion
+        except asyncio.CancelledError:
+            pass
+
+
+def main(groups: int, seconds: float) -> None:
+    for mode in ("none", "task", "worker"):
+        lags = asyncio.run(run(mode, groups, seconds))
+        print(f"{mode:>6}: {len(lags)} wake-ups  p50 {percentile(lags, 0.50):6.2f}ms  p99 {percentile(lags, 0.99):7.2f}ms  "
+              f"max {max(lags):7.2f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--groups", type=int, default=GROUPS)
+    parser.add_argument("--seconds", type=float, default=10)
+    args = parser.parse_args()
+    main(args.groups, args.seconds)
@@ -0,0 +1,172 @@
+"""Load test of `StudentBotService` with synthetic updates.
+
+Synthetic users arrive at `--rate` users per second and go through the whole
+flow: /start, group choice, name entry, confirm, verification by an admin and
+schedule taps. Every update is fed to the application the way polling and the
+webhook do, Bot API calls go to the fake Bot API and the databases are the
+local ones from `data/Scheduler/*_db_config.json`. Telegram's flood limits are
+off unless `--telegram-limits` is given, so the bot's own time is measured.
+Run from the repository root:
+
+    python -m benchmarks.load_test --users 200 --rate 20
+"""
+import argparse
+import asyncio
+import logging
+import os
+import shutil
+import tempfile
+from collections import Counter
+from itertools import count
+from time import perf_counter
+
+import telegram
+from telegram.ext import Application, ApplicationBuilder
+
+from benchmarks.fake_bot_api import FakeBotAPI, callback_update, message_update, serve
+from benchmarks.outbound_burst import CONNECTIONS, percentile
+from dispatch import PerUserUpdateProcessor
+from outbound import MeasuredRequest, OutboundScheduler
+from service_setup import SetupServiceData
+from services.StudentBot import StudentBotService
+
+FIRST_ID = 8_000_000_000_000
+ADMIN_ID = FIRST_ID - 1
+# Copied to the temporary working directory, state files of the bot are written there
+CONFIG_FILES = ("stud_db_config.json", "schedule_db_config.json", "groups.json")
+SCHEDULE_BUTTONS = ("schedule:Monday", "schedule:Wednesday", "schedule:Friday")
+
+
+class LoadTestBot(StudentBotService):
+    def __init__(self, setup_data: SetupServiceData, api_url: str, telegram_limits: bool, concurrent_updates: int) -> None:
+        self.api_url = api_url
+        super().__init__(setup_data, concurrent_updates)
+        if not telegram_limits:
+            self.outbound = OutboundScheduler(self.logger, global_rate=10**6, chat_rate=10**6, chat_burst=10**6)
+
+    def build_app(self) -> Application:
+        return (ApplicationBuilder().token("1:fake").base_url(self.api_url)
+                .request(MeasuredRequest(connection_pool_size=CONNECTIONS))
+                .concurrent_updates(PerUserUpdateProcessor(self.concurrent_updates))
+                .build())
+
+
+class LoadTest:
+    def __init__(self, service: LoadTestBot) -> None:
+        self.service = service
+        self.update_ids = count(1)
+        # Update kind: handling time of each
+        self.latencies: dict[str, list[float]] = {}
+        self.errors = Counter()
+
+    async def feed(self, kind: str, update: dict) -> None:
+        update["update_id"] = next(self.update_ids)
+        update = telegram.Update.de_json(update, self.service.app.bot)
+
+        app = self.service.app
+        start = perf_counter()
+        try:
+            # What the application does with fetched updates
+            await app.update_processor.process_update(update, app.process_update(update))
+        except Exception as e:
+            self.errors[f"{kind}: {e!r}"] += 1
+        self.latencies.setdefault(kind, []).append(perf_counter() - start)
+
+    async def setup_admin(self) -> None:
+        await self.feed("start", message_update(ADMIN_ID, "/start"))
+        await self.feed("admin", message_update(ADMIN_ID, "/admin"))
+
+    async def user(self, n: int) -> None:
+        user_id = FIRST_ID + n
+        await self.feed("start", message_update(user_id, "/start"))
+        groups = self.service.groups
+        await self.feed("group", callback_update(user_id, f"group:{groups[n % len(groups)]}"))
+        await self.feed("name", message_update(user_id, f"Load Test {n}"))
+        await self.feed("confirm", callback_update(user_id, "confirm"))
+        await self.feed("verify", callback_update(ADMIN_ID, "verify_user", text=f"Verify new user [{user_id}] Load Test {n}?"))
+        await self.feed("menu", message_update(user_id, "/menu"))
+        await self.feed("schedule", callback_update(user_id, "schedule"))
+        for button in SCHEDULE_BUTTONS:
+            await self.feed("schedule_day", callback_update(user_id, button))
+
+    async def run(self, users: int, rate: float) -> float:
+        "Returns seconds the users took"
+        start = perf_counter()
+        async with asyncio.TaskGroup() as tg:
+            for n in range(users):
+                tg.create_task(self.user(n))
+                await asyncio.sleep(1 / rate)
+        return perf_counter() - start
+
+    def report(self, elapsed: float, queries: Counter) -> None:
+        updates = sum(map(len, self.latencies.values()))
+        print(f"{updates} updates in {elapsed:.1f}s, {updates / elapsed:.1f} updates/s | "
+              f"{sum(queries.values()) / updates:.2f} DB queries per update {dict(queries)}")
+
+        for kind, latencies in (*self.latencies.items(), ("all", sum(self.latencies.values(), []))):
+            ms = [latency * 1000 for latency in latencies]
+            print(f"{kind:>13}: {len(ms):>6}  p50 {percentile(ms, 0.50):7.1f}ms  p95 {percentile(ms, 0.95):7.1f}ms  "
+                  f"p99 {percentile(ms, 0.99):7.1f}ms")
+
+        for error, errors in self.errors.most_common(10):
+            print(f"{errors} x {error}")
+
+
+async def main(port: int, users: int, rate: float, telegram_limits: bool, concurrent_updates: int) -> None:
+    server, api = serve(port, FakeBotAPI(enforce_limits=telegram_limits))
+    logger = logging.getLogger("load_test")
+    service = LoadTestBot(SetupServiceData(logger=logger, shared={}), f"http://localhost:{port}/bot",
+                          telegram_limits, concurrent_updates)
+    load_test = LoadTest(service)
+
+    service.load_stores()
+    await service.student_db.open()
+    await service.schedule_db.open()
+    await service.schedule_db.refresh()
+    await service.app.initialize()
+    await service.app.update_processor.initialize()
+    service.set_handlers()
+    outbound = asyncio.create_task(service.outbound.run())
+
+    try:
+        await load_test.setup_admin()
+        load_test.latencies.clear()
+
+        queries = Counter(service.student_db.stats)
+        elapsed = await load_test.run(users, rate)
+        queries = Counter(service.student_db.stats) - queries
+        del queries["units_of_work"]
+
+        load_test.report(elapsed, queries)
+        print(f"Bot API: {dict(api.calls)}")
+    finally:
+        outbound.cancel()
+        async with service.student_db.pool.connection() as connection:
+            await connection.execute("DELETE FROM students WHERE id >= %s", (ADMIN_ID,))
+        await service.app.shutdown()
+        await service.student_db.close()
+        await service.schedule_db.close()
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8082)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--rate", type=float, default=20, help="users starting per second")
+    parser.add_argument("--concurrent-updates", type=int, default=64, help="1 handles updates one at a time")
+    parser.add_argument("--telegram-limits", action="store_true", help="enforce and respect Telegram's flood limits")
+    args = parser.parse_args()
+
+    # Admins, verification requests and other state files of the bot stay out of ./data
+    directory = tempfile.mkdtemp()
+    os.makedirs(os.path.join(directory, "data", "Scheduler"))
+    for name in CONFIG_FILES:
+        if os.path.exists(os.path.join("data", "Scheduler", name)):
+            shutil.copy(os.path.join("data", "Scheduler", name), os.path.join(directory, "data", "Scheduler"))
+    os.chdir(directory)
+
+    try:
+        asyncio.run(main(args.port, args.users, args.rate, args.telegram_limits, args.concurrent_updates))
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,110 @@
+"""Time logging takes from a handler, direct handlers against the queue pipeline.
+
+A handler logs `--lines` messages per update, like the StudentBot does for
+starts, verifications and unit of work stats. The direct setup is the one
+`main.py` used before: a FileHandler and a stdout StreamHandler on the root
+logger. Stdout is sent to /dev/null so the terminal isn't measured, and
+`--write-delay` adds a delay to every write to the log file like a slow or busy
+disk. Run from the repository root:
+
+    python -m benchmarks.logging_overhead --updates 5000 --lines 3 --write-delay 0.5
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+from time import perf_counter, sleep
+
+from benchmarks.outbound_burst import percentile
+from logging_setup import DATE_FORMAT, TEXT_FORMAT, LoggingConfig, setup_logger
+
+
+def direct_logger(filename: str) -> logging.Logger:
+    "Setup `main.py` had before the queue"
+    logger = logging.getLogger()
+    logger.setLevel(logging.INFO)
+    formatter = logging.Formatter(TEXT_FORMAT, DATE_FORMAT)
+
+    stdout_handler = logging.StreamHandler(sys.stdout)
+    stdout_handler.setFormatter(formatter)
+    file_handler = logging.FileHandler(filename)
+    file_handler.setFormatter(formatter)
+
+    logger.addHandler(file_handler)
+    logger.addHandler(stdout_handler)
+    return logger
+
+
+def slow_down(handler: logging.Handler, delay: float) -> None:
+    "Every emit of a file handler takes `delay` seconds longer"
+    if not delay or not isinstance(handler, logging.FileHandler):
+        return
+    emit = handler.emit
+
+    def slow_emit(record: logging.LogRecord) -> None:
+        sleep(delay)
+        emit(record)
+
+    handler.emit = slow_emit
+
+
+def handle_updates(logger: logging.Logger, updates: int, lines: int) -> list[float]:
+    "Seconds spent logging by each update"
+    latencies = []
+    for update_id in range(updates):
+        start = perf_counter()
+        for line in range(lines):
+            logger.info(f"StudentBotService: Update {update_id} made {line} SELECT and 1 UPDATE queries")
+        latencies.append(perf_counter() - start)
+    return latencies
+
+
+def reset(logger: logging.Logger) -> None:
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
+        handler.close()
+
+
+def report(name: str, latencies: list[float]) -> None:
+    us = [latency * 1e6 for latency in latencies]
+    print(f"{name:>11}: p50 {percentile(us, 0.50):7.1f}us  p99 {percentile(us, 0.99):7.1f}us  "
+          f"max {max(us):8.1f}us per update, {sum(latencies):.3f}s total")
+
+
+def main(updates: int, lines: int, write_delay: float) -> None:
+    with tempfile.TemporaryDirectory() as directory, open(os.devnull, "w") as devnull:
+        sys.stdout, stdout = devnull, sys.stdout
+        try:
+            logger = direct_logger(os.path.join(directory, "direct.log"))
+            for handler in logger.handlers:
+                slow_down(handler, write_delay)
+            direct = handle_updates(logger, updates, lines)
+            reset(logger)
+
+            for name, json_output in (("queue", False), ("queue json", True)):
+                logger, listener = setup_logger(LoggingConfig(file=os.path.join(directory, f"{name}.log"), json=json_output))
+                for handler in listener.handlers:
+                    slow_down(handler, write_delay)
+                latencies = handle_updates(logger, updates, lines)
+                listener.stop()
+                reset(logger)
+                if name == "queue":
+                    queued = latencies
+                else:
+                    queued_json = latencies
+        finally:
+            sys.stdout = stdout
+
+    report("direct", direct)
+    report("queue", queued)
+    report("queue json", queued_json)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--updates", type=int, default=5000)
+    parser.add_argument("--lines", type=int, default=3)
+    parser.add_argument("--write-delay", type=float, default=0, help="milliseconds added to each log file write")
+    args = parser.parse_args()
+    main(args.updates, args.lines, args.write_delay / 1000)
@@ -0,0 +1,103 @@
+"""Burst sending with and without `OutboundScheduler`.
+
+Sends a burst of messages to many chats through the fake Bot API, first
+straight from `Bot` the way the bot used to, then through the scheduler with
+background broadcast and interactive replies mixed. Reports flood limit
+errors, completion time and interactive latency. Run from the repository root:
+
+    python -m benchmarks.outbound_burst --chats 200 --per-chat 3
+"""
+import argparse
+import asyncio
+import logging
+from time import perf_counter
+
+import telegram
+from telegram import Bot
+from telegram.request import HTTPXRequest
+
+from benchmarks.fake_bot_api import FakeBotAPI, serve
+from outbound import OutboundScheduler, Priority
+
+FIRST_CHAT = 1_000
+# Same as the Application default, so the burst is not serialized by the client
+CONNECTIONS = 256
+
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+async def direct(bot: Bot, chats: int, per_chat: int) -> tuple[int, list[float]]:
+    "Every message is sent at once, flood limited ones are lost"
+    async def send(chat_id: int, n: int) -> float | None:
+        started = perf_counter()
+        try:
+            await bot.send_message(chat_id, f"Message {n}")
+        except telegram.error.RetryAfter:
+            return None
+        return perf_counter() - started
+
+    results = await asyncio.gather(*(send(FIRST_CHAT + chat, n) for n in range(per_chat) for chat in range(chats)))
+    latencies = [result for result in results if result is not None]
+    return len(results) - len(latencies), latencies
+
+
+async def scheduled(bot: Bot, chats: int, per_chat: int, interactive: int) -> tuple[OutboundScheduler, list[float]]:
+    "Burst goes to the background lane while `interactive` replies arrive during it"
+    scheduler = OutboundScheduler(logging.getLogger("outbound_burst"))
+    runner = asyncio.create_task(scheduler.run())
+
+    async def send(chat_id: int, n: int, priority: Priority) -> float:
+        started = perf_counter()
+        await scheduler.call(chat_id, lambda: bot.send_message(chat_id, f"Message {n}"), priority)
+        return perf_counter() - started
+
+    async def replies() -> list[float]:
+        latencies = []
+        for n in range(interactive):
+            await asyncio.sleep(0.1)
+            latencies.append(await send(FIRST_CHAT + chats + n, n, Priority.INTERACTIVE))
+        return latencies
+
+    reply_latencies = asyncio.create_task(replies())
+    await asyncio.gather(*(send(FIRST_CHAT + chat, n, Priority.BACKGROUND)
+                           for n in range(per_chat) for chat in range(chats)))
+    latencies = await reply_latencies
+
+    runner.cancel()
+    return scheduler, latencies
+
+
+async def main(port: int, chats: int, per_chat: int, interactive: int) -> None:
+    total = chats * per_chat
+
+    server, api = serve(port, FakeBotAPI())
+    async with Bot("1:fake", base_url=f"http://localhost:{port}/bot",
+                   request=HTTPXRequest(CONNECTIONS)) as bot:
+        started = perf_counter()
+        lost, latencies = await direct(bot, chats, per_chat)
+        print(f"    direct: {total - lost}/{total} delivered in {perf_counter() - started:.2f}s, "
+              f"{lost} flood limited | p95 {percentile(latencies, 0.95) * 1000:.0f}ms")
+
+    server.shutdown()
+    server, api = serve(port + 1, FakeBotAPI())
+    async with Bot("1:fake", base_url=f"http://localhost:{port + 1}/bot",
+                   request=HTTPXRequest(CONNECTIONS)) as bot:
+        started = perf_counter()
+        scheduler, latencies = await scheduled(bot, chats, per_chat, interactive)
+        print(f" scheduled: {scheduler.stats['sent']}/{total + interactive} delivered in {perf_counter() - started:.2f}s, "
+              f"{api.calls['429']} flood limited, {scheduler.stats['retried']} retried | "
+              f"interactive p50 {percentile(latencies, 0.5) * 1000:.0f}ms  max {max(latencies) * 1000:.0f}ms")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8082)
+    parser.add_argument("--chats", type=int, default=200)
+    parser.add_argument("--per-chat", type=int, default=3)
+    parser.add_argument("--interactive", type=int, default=10)
+    args = parser.parse_args()
+    asyncio.run(main(args.port, args.chats, args.per_chat, args.interactive))
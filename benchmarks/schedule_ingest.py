@@ -0,0 +1,69 @@
+"""Per-row and bulk schedule ingestion on a large synthetic sheet.
+
+Loads `--groups` groups x 2 weeks into temporary tables of the schedule
+database from `data/Scheduler/schedule_db_config.json` with every
+`ScheduleWriter` mode. Run from the repository root:
+
+    python -m benchmarks.schedule_ingest --groups 50
+"""
+import argparse
+from time import perf_counter
+
+import psycopg2
+
+from benchmarks.fake_sheets import synthetic_range
+from services.ScheduleDataFetcher import ScheduleWriter, parse_range
+from services.StudentBot import load_schedule_db, split_db_config
+
+
+def run_mode(connection, mode: str, groups: int) -> tuple[int, float]:
+    cursor = connection.cursor()
+    for group_number in range(groups):
+        cursor.execute(f"""
+        CREATE TEMP TABLE bench_{group_number}
+        (day_of_week text, time text, subject text, class_type text, week int, url text)
+        """)
+    connection.commit()
+
+    lines = {
+        (f"bench_{group_number}", week): list(parse_range(synthetic_range(group_number, week), week=week))
+        for group_number in range(groups) for week in (1, 2)
+    }
+
+    writer = ScheduleWriter(cursor, mode)
+    start = perf_counter()
+    for (group, week), group_lines in lines.items():
+        writer.sync_range(group, week, group_lines)
+    connection.commit()
+    elapsed = perf_counter() - start
+
+    for group_number in range(groups):
+        cursor.execute(f"DROP TABLE bench_{group_number}")
+    connection.commit()
+    cursor.close()
+
+    return sum(map(len, lines.values())), elapsed
+
+
+def main(groups: int, repeat: int) -> None:
+    connection = psycopg2.connect(**split_db_config(load_schedule_db())[0])
+
+    try:
+        for mode in ScheduleWriter.MODES:
+            timings = []
+            for _ in range(repeat):
+                rows, elapsed = run_mode(connection, mode, groups)
+                timings.append(elapsed)
+
+            best = min(timings)
+            print(f"{mode:>6}: {rows} rows in {best*1000:.1f}ms (best of {repeat}), {rows/best:,.0f} rows/s")
+    finally:
+        connection.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--groups", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    main(args.groups, args.repeat)
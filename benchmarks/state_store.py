@@ -0,0 +1,66 @@
+"""Cost of saving one verification request as the state grows.
+
+Compares rewriting the whole YAML file, like `Verification` used to do, with
+appending to `JournaledStore`. Run from the repository root:
+
+    python -m benchmarks.state_store --sizes 100 1000 10000
+"""
+import argparse
+import logging
+import os
+import tempfile
+from time import perf_counter
+
+import yaml
+
+from journal import JournaledStore
+
+CHANGES = 50
+
+
+def messages(size: int) -> dict:
+    "Verification messages of `size` requests, sent to 5 admins of 3 groups"
+    return {f"km3{group}": {admin: {user_id: user_id + admin for user_id in range(size // 3)}
+                            for admin in range(5)}
+            for group in range(3)}
+
+
+def yaml_rewrite(directory: str, state: dict) -> float:
+    path = os.path.join(directory, "request_messages.yaml")
+    start = perf_counter()
+    for n in range(CHANGES):
+        state["km31"][0][-n - 1] = n
+        with open(path, "w") as f:
+            yaml.dump(state, f)
+    return (perf_counter() - start) / CHANGES
+
+
+def journal_append(directory: str, state: dict) -> float:
+    store = JournaledStore(os.path.join(directory, "request_messages"), logging.getLogger("state_store"),
+                           compact_every=10**9)
+    # Only the initial state, whole request dicts are set to keep it quick
+    for group, admins in state.items():
+        for admin, requests in admins.items():
+            store.set((group, admin), requests)
+
+    start = perf_counter()
+    for n in range(CHANGES):
+        store.set(("km31", 0, -n - 1), n)
+    elapsed = (perf_counter() - start) / CHANGES
+    store.close()
+    return elapsed
+
+
+def main(sizes: list[int]) -> None:
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            rewrite = yaml_rewrite(directory, messages(size))
+            append = journal_append(directory, messages(size))
+        print(f"{size:>7} requests: yaml rewrite {rewrite * 1000:8.2f}ms  journal append {append * 1000:6.2f}ms per change")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000])
+    args = parser.parse_args()
+    main(args.sizes)
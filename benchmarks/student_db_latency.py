@@ -0,0 +1,94 @@
+"""Handler latency of `StudentDB` under concurrent users.
+
+Compares the old single blocking psycopg2 connection with the pooled async
+`StudentDB`. Needs the students database from `data/Scheduler/stud_db_config.json`,
+run from the repository root:
+
+    python -m benchmarks.student_db_latency --users 60 --rounds 20
+"""
+import argparse
+import asyncio
+import statistics
+from time import perf_counter
+
+import psycopg2
+
+from services.StudentBot import StudentDB, load_db_config, split_db_config
+
+FIRST_ID = 9_000_000_000_000
+
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def report(name: str, latencies: list[float], elapsed: float) -> None:
+    ms = [latency * 1000 for latency in latencies]
+    print(f"{name:>10}: {len(ms)} handlers in {elapsed:.2f}s | "
+          f"p50 {percentile(ms, 0.50):.1f}ms  p95 {percentile(ms, 0.95):.1f}ms  "
+          f"p99 {percentile(ms, 0.99):.1f}ms  max {max(ms):.1f}ms  mean {statistics.mean(ms):.1f}ms")
+
+
+async def blocking_handler(cursor, connection, usr_id: int) -> None:
+    "Same statements `text_controller` used to run on the shared connection"
+    await asyncio.sleep(0)
+    cursor.execute("SELECT * FROM students WHERE id = %s", (usr_id,))
+    cursor.fetchone()
+    for column, value in (("real_name", "Bench User"), ("is_inputting_name", False)):
+        cursor.execute(f"UPDATE students SET {column} = %s WHERE id = %s", (value, usr_id))
+        cursor.execute("INSERT INTO students (id) VALUES (0) ON CONFLICT (id) DO NOTHING")
+        connection.commit()
+
+
+async def pooled_handler(student_db: StudentDB, usr_id: int) -> None:
+    client = await student_db.get_student(usr_id)
+    client.real_name = "Bench User"
+    client.is_inputting_name = False
+    await client.save()
+
+
+async def timed(handler, *args) -> float:
+    start = perf_counter()
+    await handler(*args)
+    return perf_counter() - start
+
+
+async def run_rounds(handler, args, users: list[int], rounds: int) -> tuple[list[float], float]:
+    latencies = []
+    start = perf_counter()
+    for _ in range(rounds):
+        latencies += await asyncio.gather(*(timed(handler, *args, usr_id) for usr_id in users))
+    return latencies, perf_counter() - start
+
+
+async def main(users_count: int, rounds: int) -> None:
+    users = list(range(FIRST_ID, FIRST_ID + users_count))
+    student_db = StudentDB()
+    await student_db.open()
+
+    try:
+        for usr_id in users:
+            await student_db.add_student(usr_id)
+
+        connection = psycopg2.connect(**split_db_config(load_db_config())[0])
+        cursor = connection.cursor()
+        latencies, elapsed = await run_rounds(blocking_handler, (cursor, connection), users, rounds)
+        report("blocking", latencies, elapsed)
+        connection.close()
+
+        latencies, elapsed = await run_rounds(pooled_handler, (student_db,), users, rounds)
+        report("pooled", latencies, elapsed)
+
+    finally:
+        async with student_db.pool.connection() as connection:
+            await connection.execute("DELETE FROM students WHERE id >= %s", (FIRST_ID,))
+        await student_db.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=60)
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(main(args.users, args.rounds))
@@ -0,0 +1,89 @@
+"""Update delivery latency, long polling against the webhook server.
+
+Pushes updates into the fake Bot API for a polling application, and posts the
+same update JSON to `WebhookServer` for a webhook one, then measures the time
+until the handler runs. Needs no database or Telegram, run from the
+repository root:
+
+    python -m benchmarks.update_latency --updates 200
+"""
+import argparse
+import asyncio
+import logging
+from time import perf_counter
+
+import httpx
+from telegram.ext import ApplicationBuilder, MessageHandler, filters
+
+from benchmarks.fake_bot_api import message_update, serve
+from benchmarks.outbound_burst import percentile
+from service_setup import UpdatesConfig
+from webhook import WebhookServer, start_updates, stop_updates
+
+SECRET = "bench-secret"
+
+
+def report(name: str, latencies: list[float], requests: int) -> None:
+    ms = [latency * 1000 for latency in latencies]
+    print(f"{name:>8}: {len(ms)} updates | p50 {percentile(ms, 0.50):.2f}ms  p95 {percentile(ms, 0.95):.2f}ms  "
+          f"max {max(ms):.2f}ms | {requests} requests to the Bot API")
+
+
+async def measure(api_port: int, webhook: WebhookServer | None, updates: int, interval: float) -> tuple[list[float], int]:
+    server, api = serve(api_port)
+    app = ApplicationBuilder().token("1:fake").base_url(f"http://localhost:{api_port}/bot").build()
+
+    # Update text: time it was sent at
+    sent: dict[str, float] = {}
+    latencies = []
+    received = asyncio.Event()
+
+    async def handler(update, context) -> None:
+        latencies.append(perf_counter() - sent[update.message.text])
+        if len(latencies) == updates:
+            received.set()
+
+    app.add_handler(MessageHandler(filters.TEXT, handler))
+    await app.initialize()
+    await app.start()
+    await start_updates(app, "bench", webhook)
+
+    async with httpx.AsyncClient() as http:
+        for n in range(updates):
+            update = message_update(1000 + n, str(n), update_id=n + 1)
+            sent[str(n)] = perf_counter()
+            if webhook is None:
+                api.push_update(update)
+            else:
+                await http.post(f"http://localhost:{webhook.config.port}/bench", json=update,
+                                headers={"X-Telegram-Bot-Api-Secret-Token": SECRET})
+            await asyncio.sleep(interval)
+
+    await asyncio.wait_for(received.wait(), 30)
+    await stop_updates(app, "bench", webhook)
+    await app.stop()
+    await app.shutdown()
+    server.shutdown()
+
+    return latencies, sum(api.calls.values())
+
+
+async def main(port: int, updates: int, interval: float) -> None:
+    latencies, requests = await measure(port, None, updates, interval)
+    report("polling", latencies, requests)
+
+    config = UpdatesConfig(mode="webhook", port=port + 2, url=f"http://localhost:{port + 2}", secret_token=SECRET)
+    webhook = WebhookServer(config, logging.getLogger("update_latency"))
+    await webhook.start()
+    latencies, requests = await measure(port + 1, webhook, updates, interval)
+    report("webhook", latencies, requests)
+    await webhook.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8082)
+    parser.add_argument("--updates", type=int, default=200)
+    parser.add_argument("--interval", type=float, default=0.01, help="seconds between updates")
+    args = parser.parse_args()
+    asyncio.run(main(args.port, args.updates, args.interval))
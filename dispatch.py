@@ -0,0 +1,78 @@
+import asyncio
+from typing import Any, Awaitable
+
+import telegram
+from telegram.ext import BaseUpdateProcessor
+
+import metrics
+
+USER_WAIT_SECONDS = metrics.Histogram("update_user_wait_seconds", "Time updates waited for earlier updates of their user")
+RUNNING_WAIT_SECONDS = metrics.Histogram("update_running_wait_seconds", "Time updates waited for a free concurrent slot")
+
+
+def update_user(update: object) -> int | None:
+    "Id updates are ordered by, None for updates from nobody in particular"
+    if not isinstance(update, telegram.Update):
+        return None
+    if update.effective_user is not None:
+        return update.effective_user.id
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    return None
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Updates of different users are handled concurrently, at most `max_concurrent_updates`
+    at a time. Updates of one user are handled one by one in the order they came in"""
+    # PTB takes its own semaphore before `do_process_update`, updates waiting there for
+    # their user would hold slots other users could run in. So PTB's one only bounds
+    # updates in flight and the limit is taken once the user's earlier updates are done
+    MAX_PENDING_UPDATES = 10_000
+
+    def __init__(self, max_concurrent_updates: int) -> None:
+        if max_concurrent_updates < 1:
+            raise ValueError("`max_concurrent_updates` must be a positive integer!")
+        # `max_concurrent_updates` of PTB is the pending limit then
+        super().__init__(self.MAX_PENDING_UPDATES)
+        self.max_running_updates = max_concurrent_updates
+        self._running = asyncio.Semaphore(max_concurrent_updates)
+        # User id: lock held while one of their updates is handled
+        self._locks: dict[int, asyncio.Lock] = {}
+        # User id: their updates being handled or waiting, the lock is dropped at 0
+        self._pending: dict[int, int] = {}
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        user = update_user(update)
+        if user is None:
+            await self._run(coroutine)
+            return
+
+        # Locks are FIFO and updates get here in the order they were fetched
+        lock = self._locks.setdefault(user, asyncio.Lock())
+        self._pending[user] = self._pending.get(user, 0) + 1
+        try:
+            with USER_WAIT_SECONDS.time():
+                await lock.acquire()
+            try:
+                await self._run(coroutine)
+            finally:
+                lock.release()
+        finally:
+            self._pending[user] -= 1
+            if not self._pending[user]:
+                del self._pending[user]
+                del self._locks[user]
+
+    async def _run(self, coroutine: Awaitable[Any]) -> None:
+        with RUNNING_WAIT_SECONDS.time():
+            await self._running.acquire()
+        try:
+            await coroutine
+        finally:
+            self._running.release()
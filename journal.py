@@ -0,0 +1,149 @@
+import asyncio
+import json
+import logging
+import os
+from typing import Any, Iterator
+
+# (op, path, value), op is "set" or "delete"
+ENTRY = list
+
+
+def set_entry(path: tuple, value: Any) -> ENTRY:
+    return ["set", list(path), value]
+
+
+def delete_entry(path: tuple) -> ENTRY:
+    return ["delete", list(path), None]
+
+
+class JournaledStore:
+    """Nested dict persisted as a snapshot and an append-only journal of changes.
+    A change appends and fsyncs one line however large the state is. Once the journal
+    has `compact_every` lines the state is written to a new snapshot and the journal
+    starts over. Keys are paths of JSON values, so int keys stay ints.
+    `set`, `delete` and `compact` block, on the event loop changes go through `apply`"""
+
+    def __init__(self, path: str, logger: logging.Logger, compact_every: int = 1000) -> None:
+        self.logger = logger
+        self.snapshot_path = f"{path}.snapshot"
+        self.journal_path = f"{path}.journal"
+        self.compact_every = compact_every
+
+        # True if there was nothing to load, callers may import their old files then
+        self.created = not (os.path.exists(self.snapshot_path) or os.path.exists(self.journal_path))
+        self.data: dict = {}
+        self._replay(self.snapshot_path)
+        self._journal_entries = self._replay(self.journal_path)
+        self._journal = open(self.journal_path, "a", encoding="utf-8")
+        # Serializes file writes of `apply`, it's fair so the journal keeps the order of the changes
+        self._write_lock = asyncio.Lock()
+
+        if self._journal_entries >= self.compact_every:
+            self.compact()
+
+    def set(self, path: tuple, value: Any) -> None:
+        self._append(set_entry(path, value))
+
+    def delete(self, path: tuple) -> None:
+        self._append(delete_entry(path))
+
+    async def apply(self, entries: list[ENTRY]) -> None:
+        """Applies the entries to `data` at once and writes them with a single fsync in a thread.
+        Compaction that is due runs in a thread as well"""
+        if not entries:
+            return
+        for entry in entries:
+            self._apply(entry)
+        lines = "".join(json.dumps(entry) + "\n" for entry in entries)
+
+        async with self._write_lock:
+            await asyncio.to_thread(self._write, lines)
+            self._journal_entries += len(entries)
+            if self._journal_entries >= self.compact_every:
+                # Changes applied meanwhile are in the snapshot and appended after it again,
+                # replaying them in order over it gives the same state
+                await asyncio.to_thread(self._write_snapshot, self._snapshot())
+
+    def compact(self) -> None:
+        "Writes the state as a new snapshot and empties the journal"
+        self._write_snapshot(self._snapshot())
+
+    def close(self) -> None:
+        self._journal.close()
+
+    def _append(self, entry: ENTRY) -> None:
+        self._apply(entry)
+        self._write(json.dumps(entry) + "\n")
+
+        self._journal_entries += 1
+        if self._journal_entries >= self.compact_every:
+            self.compact()
+
+    def _write(self, lines: str) -> None:
+        self._journal.write(lines)
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+    def _snapshot(self) -> str:
+        "State as entries, taken on the loop since `data` changes there"
+        return "".join(json.dumps(set_entry(path, value)) + "\n" for path, value in self._leaves(self.data, ()))
+
+    def _write_snapshot(self, snapshot: str) -> None:
+        temporary_path = f"{self.snapshot_path}.tmp"
+        with open(temporary_path, "w", encoding="utf-8") as f:
+            f.write(snapshot)
+            f.flush()
+            os.fsync(f.fileno())
+
+        # Replaying the old journal over the new snapshot gives the same state,
+        # so a crash before the journal is emptied loses nothing
+        os.replace(temporary_path, self.snapshot_path)
+        self._journal.close()
+        self._journal = open(self.journal_path, "w", encoding="utf-8")
+        self._journal_entries = 0
+
+    def _apply(self, entry: ENTRY) -> None:
+        op, (*parents, key), value = entry
+        node = self.data
+        for part in parents:
+            node = node.setdefault(part, {})
+
+        if op == "set":
+            node[key] = value
+        else:
+            node.pop(key, None)
+
+    def _replay(self, filename: str) -> int:
+        "Applies entries of the file, returns their amount"
+        try:
+            with open(filename, "rb") as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return 0
+
+        entries = 0
+        offset = 0
+        for line in lines:
+            try:
+                self._apply(json.loads(line))
+            except (ValueError, TypeError) as e:
+                if not line.endswith(b"\n"):
+                    # Write torn by a crash, appending after it would corrupt the next entry
+                    self.logger.warning(f"Journal: Dropped incomplete last entry of {filename}")
+                    with open(filename, "r+b") as f:
+                        f.truncate(offset)
+                    break
+                self.logger.error(f"Journal: Skipped corrupted entry of {filename}: {e!r}")
+            else:
+                entries += 1
+            offset += len(line)
+
+        return entries
+
+    @classmethod
+    def _leaves(cls, node: dict, path: tuple) -> Iterator[tuple[tuple, Any]]:
+        for key, value in node.items():
+            if isinstance(value, dict) and value:
+                yield from cls._leaves(value, (*path, key))
+            else:
+                yield (*path, key), value
@@ -0,0 +1,46 @@
+from time import perf_counter
+from typing import Awaitable, Protocol, TypeVar
+
+T = TypeVar("T")
+
+
+class Service(Protocol):
+    """Driven by `Main`: `setup` of every service runs concurrently, then `run` of every
+    service, `shutdown` is called once `run` ended or `setup` failed"""
+    async def setup(self) -> None: ...
+
+    async def run(self) -> None: ...
+
+    async def shutdown(self) -> None: ...
+
+
+class StartupTimer:
+    "Seconds each startup phase took. Phases may overlap, the total is the time since `started`"
+    def __init__(self, started: float | None = None) -> None:
+        # perf_counter() value, now by default
+        self.started = perf_counter() if started is None else started
+        # Phase: seconds, in the order they finished
+        self.phases: dict[str, float] = {}
+
+    async def time(self, phase: str, awaitable: Awaitable[T]) -> T:
+        start = perf_counter()
+        try:
+            return await awaitable
+        finally:
+            self.phases[phase] = perf_counter() - start
+
+    def elapsed(self) -> float:
+        return perf_counter() - self.started
+
+    def report(self) -> str:
+        phases = ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in self.phases.items())
+        return f"{self.elapsed():.2f}s ({phases})"
+
+
+async def serve(service: Service) -> None:
+    "Runs a single service the way `Main` runs all of them"
+    try:
+        await service.setup()
+        await service.run()
+    finally:
+        await service.shutdown()
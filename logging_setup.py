@@ -0,0 +1,119 @@
+import copy
+import json
+import logging
+import os
+import queue
+import sys
+from dataclasses import dataclass
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
+
+LOGGING = './data/logging.json'
+TEXT_FORMAT = '%(asctime)s | %(levelname)s | %(message)s'
+DATE_FORMAT = '%m-%d-%Y %H:%M:%S'
+
+
+@dataclass(frozen=True)
+class LoggingConfig:
+    file: str = 'logs.log'
+    level: str = 'INFO'
+    # Rotated at `when` and also once the file reaches `max_bytes`, 0 disables it
+    when: str = 'midnight'
+    max_bytes: int = 10 * 1024 * 1024
+    backup_count: int = 14
+    # One JSON object per line instead of text
+    json: bool = False
+
+
+def load_logging_config(filename=LOGGING) -> LoggingConfig:
+    try:
+        with open(filename, 'r') as f:
+            return LoggingConfig(**json.load(f))
+    except FileNotFoundError:
+        return LoggingConfig()
+
+
+class SizedTimedRotatingFileHandler(TimedRotatingFileHandler):
+    "Rotates at `when` like its parent and also once the file would exceed `max_bytes`"
+    def __init__(self, filename: str, max_bytes: int = 0, **kwargs) -> None:
+        super().__init__(filename, **kwargs)
+        self.max_bytes = max_bytes
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if super().shouldRollover(record):
+            return True
+        if self.max_bytes <= 0:
+            return False
+
+        if self.stream is None:
+            self.stream = self._open()
+        return self.stream.tell() + len(self.format(record)) + 1 > self.max_bytes
+
+    def rotation_filename(self, default_name: str) -> str:
+        # Several size rotations within one interval would overwrite each other,
+        # numbers are padded so old files still sort first when the oldest are deleted
+        name = super().rotation_filename(default_name)
+        n = 0
+        while os.path.exists(name):
+            n += 1
+            name = f"{default_name}.{n:03d}"
+        return name
+
+
+class RecordQueueHandler(QueueHandler):
+    """Queues records with the message and the traceback apart. The default `prepare`
+    merges the traceback into the message, formatters of the listener couldn't tell them apart"""
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        # Arguments and exc_info may not survive pickling for worker processes
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = (self.formatter or logging.Formatter()).formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            # Formatted already by `RecordQueueHandler`
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def create_handlers(config: LoggingConfig) -> list[logging.Handler]:
+    formatter = JsonFormatter() if config.json else logging.Formatter(TEXT_FORMAT, DATE_FORMAT)
+
+    stdout_handler = logging.StreamHandler(sys.stdout)
+    stdout_handler.setLevel(logging.DEBUG)
+    stdout_handler.setFormatter(formatter)
+
+    file_handler = SizedTimedRotatingFileHandler(config.file, max_bytes=config.max_bytes, when=config.when,
+                                                 backupCount=config.backup_count, encoding='utf-8')
+    file_handler.setLevel(logging.DEBUG)
+    file_handler.setFormatter(formatter)
+
+    return [file_handler, stdout_handler]
+
+
+def setup_logger(config: LoggingConfig) -> tuple[logging.Logger, QueueListener]:
+    """Root logger only puts records into a queue, a listener thread formats and writes them.
+    Stop the returned listener on exit to write the remaining records"""
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, *create_handlers(config), respect_handler_level=True)
+    listener.start()
+
+    logger = logging.getLogger()
+    logger.setLevel(config.level)
+    logger.addHandler(RecordQueueHandler(log_queue))
+
+    return logger, listener
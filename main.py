@@ -1,39 +1,45 @@
 import asyncio
-import sys
-import logging
+from time import perf_counter
 
-from service_setup import SetupServiceData
+# Import time is part of the startup report
+STARTED = perf_counter()
+
+from lifecycle import Service, StartupTimer
+from logging_setup import load_logging_config, setup_logger
+from metrics import MetricsServer, load_metrics_config
+from service_setup import SetupServiceData, load_updates_config
+from webhook import WebhookServer
+from workers import WorkerProcess, load_workers_config
 # from services.Example import ExampleService
 from services.StudentBot import StudentBotService
 
 
-def setup_logger() -> logging.Logger:
-    logger = logging.getLogger()
-    logger.setLevel(logging.INFO)
-    formatter = logging.Formatter('%(asctime)s | %(levelname)s | %(message)s', 
-                                '%m-%d-%Y %H:%M:%S')
-
-    stdout_handler = logging.StreamHandler(sys.stdout)
-    stdout_handler.setLevel(logging.DEBUG)
-    stdout_handler.setFormatter(formatter)
-
-    file_handler = logging.FileHandler('logs.log')
-    file_handler.setLevel(logging.DEBUG)
-    file_handler.setFormatter(formatter)
-
-    logger.addHandler(file_handler)
-    logger.addHandler(stdout_handler)
-
-    return logger
-
-
 class Main:
     def __init__(self):
-        self.logger = setup_logger()
+        self.timer = StartupTimer(started=STARTED)
+        self.timer.phases["imports"] = self.timer.elapsed()
+        self.logger, self.log_listener = setup_logger(load_logging_config())
+        self.updates_config = load_updates_config()
+        self.metrics_config = load_metrics_config()
+        self.workers_config = load_workers_config()
         self.setup_data = self.create_setup_data()
 
     def create_setup_data(self) -> SetupServiceData:
         return SetupServiceData(logger=self.logger, shared={})
+
+    def create_workers(self) -> list[WorkerProcess]:
+        workers = []
+        if self.workers_config.schedule_fetcher:
+            # Its Google and psycopg2 dependencies are only needed in the worker process
+            from services.ScheduleDataFetcher import run_worker
+            workers.append(WorkerProcess("ScheduleDataFetcher", run_worker, self.logger,
+                                         self.workers_config.restart_delay, self.workers_config.max_restart_delay))
+        return workers
+
+    async def setup_services(self, services: list[Service]) -> None:
+        async with asyncio.TaskGroup() as tg:
+            for service in services:
+                tg.create_task(service.setup())
     
     def run(self):
         try:
@@ -42,16 +48,44 @@ class Main:
             self.logger.exception(e)
         finally:
             self.logger.info("Boot: Exiting...")
+            self.log_listener.stop()
 
     async def async_run(self):
+        metrics_server = None
+        if self.metrics_config.enabled:
+            metrics_server = MetricsServer(self.metrics_config, self.logger)
+            await metrics_server.start()
+
+        if self.updates_config.mode == "webhook":
+            self.setup_data.webhook = WebhookServer(self.updates_config, self.logger)
+            await self.setup_data.webhook.start()
+
         self.logger.info("Boot: Setting up services")
-        # example_service = ExampleService(self.setup_data)
-        student_bot_service = StudentBotService(self.setup_data)
+        services: list[Service] = [
+            # ExampleService(self.setup_data),
+            StudentBotService(self.setup_data),
+        ]
+        workers = self.create_workers()
 
-        self.logger.info("Boot: Running services")
-        async with asyncio.TaskGroup() as tg:
-            # tg.create_task(example_service.run())
-            tg.create_task(student_bot_service.run())
+        try:
+            await self.timer.time("setup", self.setup_services(services))
+            self.logger.info(f"Boot: Running services, ready in {self.timer.report()}")
+
+            async with asyncio.TaskGroup() as tg:
+                for service in services:
+                    tg.create_task(service.run())
+                for worker in workers:
+                    tg.create_task(worker.run())
+        finally:
+            results = await asyncio.gather(*(service.shutdown() for service in services), return_exceptions=True)
+            for service, result in zip(services, results):
+                if isinstance(result, Exception):
+                    self.logger.error(f"Boot: Shutdown of {type(service).__name__} failed: {result!r}")
+
+            if self.setup_data.webhook is not None:
+                await self.setup_data.webhook.close()
+            if metrics_server is not None:
+                await metrics_server.close()
 
 if __name__ == "__main__":
     main = Main()
@@ -0,0 +1,159 @@
+import asyncio
+import json
+import logging
+from contextlib import contextmanager
+from dataclasses import dataclass
+from math import inf
+from time import perf_counter
+from typing import Iterator
+
+METRICS = './data/metrics.json'
+# Seconds, from a cached lookup to a slow Bot API call
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+@dataclass(frozen=True)
+class MetricsConfig:
+    enabled: bool = True
+    listen: str = "127.0.0.1"
+    port: int = 9108
+
+
+def load_metrics_config(filename=METRICS) -> MetricsConfig:
+    try:
+        with open(filename, 'r') as f:
+            return MetricsConfig(**json.load(f))
+    except FileNotFoundError:
+        return MetricsConfig()
+
+
+# Name: metric, filled by their constructors
+REGISTRY: dict[str, "Metric"] = {}
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metric:
+    "Values by label values. Created once at import time, listed in `REGISTRY`"
+    type = ""
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values: dict[tuple[str, ...], object] = {}
+        REGISTRY[name] = self
+
+    def _key(self, labels: dict[str, str]) -> tuple[str, ...]:
+        if labels.keys() != set(self.labels):
+            raise ValueError(f"{self.name} has labels {self.labels}, got {tuple(labels)}")
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def _label_text(self, key: tuple[str, ...], **extra: str) -> str:
+        pairs = [*zip(self.labels, key), *extra.items()]
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{label}="{escape_label(value)}"' for label, value in pairs) + "}"
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.type}"
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> Iterator[str]:
+        yield from super().render()
+        for key, value in self._values.items():
+            yield f"{self.name}{self._label_text(key)} {value}"
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = (*buckets, inf)
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        # [count of each bucket, sum]
+        state = self._values.get(key)
+        if state is None:
+            state = self._values[key] = [[0] * len(self.buckets), 0.0]
+
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[0][i] += 1
+                break
+        state[1] += value
+
+    @contextmanager
+    def time(self, **labels: str):
+        "Observes seconds the block took, also when it raises"
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, **labels)
+
+    def render(self) -> Iterator[str]:
+        yield from super().render()
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = "+Inf" if bound == inf else repr(float(bound))
+                yield f"{self.name}_bucket{self._label_text(key, le=le)} {cumulative}"
+            yield f"{self.name}_sum{self._label_text(key)} {total}"
+            yield f"{self.name}_count{self._label_text(key)} {cumulative}"
+
+
+def render() -> str:
+    "Every metric in Prometheus text format"
+    return "\n".join(line for metric in REGISTRY.values() for line in metric.render()) + "\n"
+
+
+class MetricsServer:
+    "Serves `render()` on GET /metrics"
+    def __init__(self, config: MetricsConfig, logger: logging.Logger) -> None:
+        self.config = config
+        self.logger = logger
+        self._server: asyncio.Server | None = None
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._serve, self.config.listen, self.config.port)
+        self.logger.info(f"Metrics: Serving on http://{self.config.listen}:{self.config.port}/metrics")
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request_line = (await reader.readline()).decode("latin-1").split(" ")
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+
+            if request_line[:2] == ["GET", "/metrics"]:
+                body = render().encode()
+                head = "HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            else:
+                body = b""
+                head = "HTTP/1.1 404 Not Found\r\n"
+
+            writer.write(f"{head}Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except ConnectionError as e:
+            self.logger.debug(f"Metrics: Dropped connection: {e!r}")
+        finally:
+            writer.close()
@@ -0,0 +1,240 @@
+import asyncio
+import logging
+from collections import Counter, deque
+from dataclasses import dataclass
+from datetime import timedelta
+from enum import IntEnum
+from itertools import islice
+from typing import Any, Awaitable, Callable
+
+import telegram
+from telegram.request import HTTPXRequest
+
+import metrics
+
+TELEGRAM_SECONDS = metrics.Histogram("telegram_api_seconds", "Bot API call time", ("method",))
+TELEGRAM_RESPONSES = metrics.Counter("telegram_api_responses_total", "Bot API responses by HTTP status", ("method", "status"))
+OUTBOUND_WAIT_SECONDS = metrics.Histogram("outbound_wait_seconds", "Time calls spent queued in OutboundScheduler", ("priority",))
+OUTBOUND_CALLS = metrics.Counter("outbound_calls_total", "Calls finished by OutboundScheduler", ("priority", "outcome"))
+
+
+class Priority(IntEnum):
+    "Lower value is dispatched first"
+    INTERACTIVE = 0
+    BACKGROUND = 1
+
+
+class TokenBucket:
+    "`rate` tokens per second, at most `capacity` stored. Time is passed in by the caller"
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated: float | None = None
+        self.paused_until = 0.0
+
+    def _fill(self, now: float) -> None:
+        if self.updated is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        "Seconds until a token is available, 0 if it is now"
+        if now < self.paused_until:
+            return self.paused_until - now
+
+        self._fill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self, now: float) -> None:
+        self._fill(now)
+        self.tokens -= 1
+
+    def pause(self, now: float, seconds: float) -> None:
+        self.paused_until = max(self.paused_until, now + seconds)
+        self.tokens = 0
+
+    def is_idle(self, now: float) -> bool:
+        self._fill(now)
+        return self.tokens >= self.capacity and now >= self.paused_until
+
+
+class MeasuredRequest(HTTPXRequest):
+    "Times every Bot API call of the bot, except getUpdates which has its own request"
+    async def do_request(self, url: str, method: str, *args, **kwargs) -> tuple[int, bytes]:
+        endpoint = url.rsplit("/", 1)[-1]
+        with TELEGRAM_SECONDS.time(method=endpoint):
+            status, payload = await super().do_request(url, method, *args, **kwargs)
+        TELEGRAM_RESPONSES.inc(method=endpoint, status=status)
+        return status, payload
+
+
+@dataclass
+class OutboundJob:
+    chat_id: int
+    method: Callable[[], Awaitable]
+    priority: Priority
+    future: asyncio.Future
+    queued_at: float
+    attempts: int = 0
+
+
+def retry_after_seconds(error: telegram.error.RetryAfter) -> float:
+    if isinstance(error.retry_after, timedelta):
+        return error.retry_after.total_seconds()
+    return float(error.retry_after)
+
+
+class OutboundScheduler:
+    """Every Bot API call made to a chat goes through `call`. Calls wait for the global
+    and the chat's token bucket, interactive ones are dispatched ahead of background ones
+    and calls answered with RetryAfter are paused for the chat and retried.
+    Defaults follow Telegram's limits: 30 messages per second overall, about one per
+    second in a private chat and 20 per minute in a group"""
+    # Jobs per lane checked for a chat that can be sent to
+    SCAN_LIMIT = 200
+    # Idle chat buckets are dropped once there are more of them
+    MAX_CHAT_BUCKETS = 10_000
+
+    def __init__(self, logger: logging.Logger, global_rate: float = 30, chat_rate: float = 1,
+                 chat_burst: float = 3, group_rate: float = 20/60, max_retries: int = 3) -> None:
+        self.logger = logger
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_buckets: dict[int, TokenBucket] = {}
+        self.lanes: dict[Priority, deque[OutboundJob]] = {priority: deque() for priority in Priority}
+        self._wakeup = asyncio.Event()
+        # Running calls, referenced so they aren't garbage collected
+        self._tasks: set[asyncio.Task] = set()
+        # Totals of "sent", "retried", "failed" calls and "wait" seconds spent queued
+        self.stats = Counter()
+        self.closed = False
+
+    async def call(self, chat_id: int, method: Callable[[], Awaitable], priority: Priority = Priority.INTERACTIVE) -> Any:
+        "Returns result of `method()` once it was dispatched"
+        if self.closed:
+            raise RuntimeError("Outbound scheduler is closed")
+
+        loop = asyncio.get_running_loop()
+        job = OutboundJob(chat_id, method, priority, loop.create_future(), loop.time())
+        self.lanes[priority].append(job)
+        self._wakeup.set()
+        return await job.future
+
+    def close(self) -> None:
+        """Fails queued calls and the ones made from now on. Only `run` resolves calls,
+        callers would wait for good once it doesn't run anymore"""
+        self.closed = True
+        for lane in self.lanes.values():
+            while lane:
+                self._fail(lane.popleft(), RuntimeError("Outbound scheduler is closed"))
+
+    def queued(self) -> int:
+        return sum(map(len, self.lanes.values()))
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+
+        while True:
+            job, delay = self._next_job(loop.time())
+            if job is not None:
+                task = loop.create_task(self._execute(job))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+                continue
+
+            self._wakeup.clear()
+            try:
+                async with asyncio.timeout(delay):
+                    await self._wakeup.wait()
+            except TimeoutError:
+                pass
+
+    def _chat_bucket(self, chat_id: int, now: float) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is not None:
+            return bucket
+
+        if len(self.chat_buckets) >= self.MAX_CHAT_BUCKETS:
+            self.chat_buckets = {id: bucket for id, bucket in self.chat_buckets.items() if not bucket.is_idle(now)}
+
+        # Group and channel ids are negative
+        rate = self.chat_rate if chat_id > 0 else self.group_rate
+        bucket = self.chat_buckets[chat_id] = TokenBucket(rate, self.chat_burst if chat_id > 0 else 1)
+        return bucket
+
+    def _next_job(self, now: float) -> tuple[OutboundJob | None, float | None]:
+        "Returns a job to dispatch now, or seconds to wait for one (None is until a new job)"
+        if not any(self.lanes.values()):
+            return None, None
+
+        global_delay = self.global_bucket.delay(now)
+        if global_delay > 0:
+            return None, global_delay
+
+        earliest = None
+        for lane in self.lanes.values():
+            for job in islice(lane, self.SCAN_LIMIT):
+                if job.future.done():
+                    # Caller gave up waiting
+                    lane.remove(job)
+                    return self._next_job(now)
+
+                bucket = self._chat_bucket(job.chat_id, now)
+                delay = bucket.delay(now)
+                if delay == 0:
+                    lane.remove(job)
+                    bucket.consume(now)
+                    self.global_bucket.consume(now)
+                    return job, 0
+
+                earliest = delay if earliest is None else min(earliest, delay)
+
+        return None, earliest
+
+    async def _execute(self, job: OutboundJob) -> None:
+        loop = asyncio.get_running_loop()
+        job.attempts += 1
+        priority = job.priority.name.lower()
+        self.stats["wait"] += loop.time() - job.queued_at
+        OUTBOUND_WAIT_SECONDS.observe(loop.time() - job.queued_at, priority=priority)
+
+        try:
+            result = await job.method()
+        except telegram.error.RetryAfter as e:
+            retry_after = retry_after_seconds(e)
+            self._chat_bucket(job.chat_id, loop.time()).pause(loop.time(), retry_after)
+
+            if job.attempts > self.max_retries or self.closed:
+                self.stats["failed"] += 1
+                OUTBOUND_CALLS.inc(priority=priority, outcome="failed")
+                self._fail(job, e)
+                return
+
+            self.stats["retried"] += 1
+            OUTBOUND_CALLS.inc(priority=priority, outcome="retried")
+            self.logger.warning(f"Outbound: Chat {job.chat_id} flood limited, retrying in {retry_after} seconds")
+            job.queued_at = loop.time()
+            # Goes ahead of later calls to the same chat
+            self.lanes[job.priority].appendleft(job)
+            self._wakeup.set()
+        except Exception as e:
+            self.stats["failed"] += 1
+            OUTBOUND_CALLS.inc(priority=priority, outcome="failed")
+            self._fail(job, e)
+        else:
+            self.stats["sent"] += 1
+            OUTBOUND_CALLS.inc(priority=priority, outcome="sent")
+            if not job.future.done():
+                job.future.set_result(result)
+
+    @staticmethod
+    def _fail(job: OutboundJob, error: BaseException) -> None:
+        if not job.future.done():
+            job.future.set_exception(error)
@@ -1,8 +1,14 @@
 from dataclasses import dataclass
+from typing import Any
 import logging
 import json
 from enum import Enum, auto
 
+GROUPS = './data/Scheduler/groups.json'
+UPDATES = './data/updates.json'
+# Postgres channel ScheduleDataFetcherService notifies after committing schedule changes
+SCHEDULE_CHANNEL = 'schedule_changed'
+
 class GlobalEvents(Enum):
     Exit = auto()
 
@@ -11,6 +17,28 @@ class GlobalEvents(Enum):
 class SetupServiceData:
     logger: logging.Logger
     shared: dict
+    # WebhookServer bots register to, None when they poll
+    webhook: Any = None
+
+
+@dataclass(frozen=True)
+class UpdatesConfig:
+    "How bots receive updates, `mode` is polling or webhook"
+    mode: str = "polling"
+    listen: str = "127.0.0.1"
+    port: int = 8443
+    # Public url Telegram posts updates to, proxied to `listen:port`
+    url: str = ""
+    # Generated on every start if empty
+    secret_token: str = ""
+
+
+def load_updates_config(filename=UPDATES) -> UpdatesConfig:
+    try:
+        with open(filename, 'r') as f:
+            return UpdatesConfig(**json.load(f))
+    except FileNotFoundError:
+        return UpdatesConfig()
 
 def _clear_unwanted_characters(s: str) -> str:
     return s.replace('\n', '').replace('\r', '').replace('\t', '').replace('  ', ' ').strip()
@@ -18,3 +46,40 @@ def _clear_unwanted_characters(s: str) -> str:
 def get_token(id_: str):
     with open('data\\tokens.json') as f:
         return _clear_unwanted_characters(json.load(f)[id_])
+
+
+@dataclass(frozen=True)
+class Group:
+    name: str
+    title: str
+    sheet: str
+    # Week: cells of the week's schedule in the group's sheet
+    ranges: dict[int, str]
+
+    def sheet_ranges(self) -> dict[int, str]:
+        return {week: f"{self.sheet}!{cells}" for week, cells in self.ranges.items()}
+
+
+def _default_groups() -> dict[str, dict]:
+    return {
+        f"km3{n}": {"title": f"Km-3{n}", "sheet": f"KM3{n}", "ranges": {"1": "A3:E32", "2": "G3:K32"}}
+        for n in (1, 2, 3)
+    }
+
+
+def load_groups(filename=GROUPS) -> list[Group]:
+    """Group registry, `{name: {"title", "sheet", "ranges": {week: cells}}}`.
+    Falls back to km31-km33 if the file doesn't exist"""
+    try:
+        with open(filename, 'r') as f:
+            groups = json.load(f)
+    except FileNotFoundError:
+        groups = _default_groups()
+
+    return [
+        Group(name=name,
+              title=group.get("title", name),
+              sheet=group.get("sheet", name.upper()),
+              ranges={int(week): cells for week, cells in group["ranges"].items()})
+        for name, group in groups.items()
+    ]
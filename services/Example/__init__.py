@@ -6,6 +6,7 @@ from telegram.ext import ApplicationBuilder, CommandHandler
 from functools import partial
 
 from service_setup import SetupServiceData, get_token
+from webhook import start_updates, stop_updates
 CHATS = ".\\data\\Example\\chats.json"
 
 
@@ -28,17 +29,19 @@ class ExampleService:
         self.setup_data = setup_data
         self.app = ApplicationBuilder().token(get_token("Example")).build()
 
-    async def run(self):
+    async def setup(self):
         self.setup_data.logger.info("Example service: Starting")
+        await self.bot_setup()
 
-        try:
-            await self.bot_setup()
+    async def run(self):
+        while True:
+            await self.mainloop()
 
-            while True:
-                await self.mainloop()
-        finally:
-            await self.app.updater.stop()
+    async def shutdown(self):
+        await stop_updates(self.app, "Example", self.setup_data.webhook)
+        if self.app.running:
             await self.app.stop()
+        await self.app.shutdown()
 
     async def bot_setup(self):
         await self.app.initialize()
@@ -57,7 +60,7 @@ class ExampleService:
         self.app.add_handler(
             CommandHandler("huh", partial(self.Commands.huh, wrapper)))
 
-        await self.app.updater.start_polling()
+        await start_updates(self.app, "Example", self.setup_data.webhook)
 
     async def mainloop(self):
         ...
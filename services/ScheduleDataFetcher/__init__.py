@@ -1,14 +1,63 @@
 import asyncio
-from service_setup import SetupServiceData
+from service_setup import SCHEDULE_CHANNEL, SetupServiceData, Group, load_groups
+from lifecycle import StartupTimer, serve
 from time import perf_counter
-from typing import Iterator
-from google.oauth2 import service_account
-from google.auth.transport.requests import Request
+from typing import TYPE_CHECKING, Iterator
+from collections import Counter
+from datetime import datetime, timezone
+from concurrent.futures import ProcessPoolExecutor
+import importlib.util
+import multiprocessing
+import logging
+import hashlib
+import json
+import csv
+import io
 import psycopg2
+from psycopg2 import sql
+from psycopg2.extras import execute_values
 import httpx
 
+if TYPE_CHECKING:
+    # Imported when credentials are loaded, google-auth takes long to import
+    from google.oauth2 import service_account
+
 
 LINE = tuple[str, str, str, str, str, str]
+# Row location in the table, used to match rows instead of a primary key
+CTID = str
+
+LINE_COLUMNS = sql.SQL("day_of_week, time, subject, class_type, week, url")
+
+FETCHER_CONFIG_DEFAULTS = {
+    # "row": INSERT per line, "values": multi-row INSERT, "copy": COPY FROM STDIN
+    "ingest_mode": "values",
+    "spreadsheet_id": "1gsxm1onrT76UYZxuT7b-qyO-haWiWk7igKwvSB0LLbg",
+    # None sends requests without authorization, for a local fake API
+    "credentials_file": "./data/StudentBot/schedule_file_api_creds.json",
+    "sheets_api_url": "https://sheets.googleapis.com",
+    "drive_api_url": "https://www.googleapis.com",
+    # Seconds between polls: the minimum right after an edit, multiplied by
+    # `poll_backoff` for every poll without changes up to the maximum
+    "min_poll_interval": 30,
+    "max_poll_interval": 10*60,
+    "poll_backoff": 2,
+    # Ranges per batchGet request and requests in flight at once
+    "shard_size": 20,
+    "fetch_concurrency": 4,
+    # Processes parsing value ranges
+    "parse_workers": 2,
+}
+
+
+def load_fetcher_config(filename='./data/Scheduler/fetcher_config.json') -> dict:
+    try:
+        with open(filename, 'r') as file:
+            config = json.load(file)
+    except FileNotFoundError:
+        config = {}
+
+    return FETCHER_CONFIG_DEFAULTS | config
 
 
 def parse_line(line: list[str], current_day_of_week: list[str], week=1) -> LINE | None:
@@ -40,31 +89,243 @@ def parse_range(data: list[list[str]], week=1) -> Iterator[LINE]:
             yield parsed_line
 
 
+def hash_range(data: list[list[str]]) -> str:
+    return hashlib.sha256(json.dumps(data, ensure_ascii=False).encode()).hexdigest()
+
+
+def prepare_range(data: list[list[str]], week: int, known_hash: str | None) -> tuple[str, list[LINE] | None]:
+    """Returns hash of the range and its parsed lines, or None instead of lines
+    if the hash is `known_hash`. Runs in worker processes"""
+    range_hash = hash_range(data)
+    if range_hash == known_hash:
+        return range_hash, None
+    return range_hash, list(parse_range(data, week=week))
+
+
+def line_slot(line: LINE) -> tuple[str, str, str]:
+    "Lines of the same slot are updated into each other instead of delete and insert"
+    day_of_week, time, _, _, week, _ = line
+    return day_of_week, time, str(week)
+
+
+def diff_lines(existing: list[tuple[CTID, LINE]], new: list[LINE]) -> tuple[list[LINE], list[tuple[CTID, LINE]], list[CTID]]:
+    """Returns (inserts, updates, deletes) turning `existing` rows into `new` lines.
+    Lines are compared as text, duplicates are matched one to one"""
+    # Line: ctids of existing rows with it
+    unmatched: dict[tuple[str, ...], list[CTID]] = {}
+    for ctid, line in existing:
+        unmatched.setdefault(tuple(map(str, line)), []).append(ctid)
+
+    added = []
+    for line in new:
+        ctids = unmatched.get(tuple(map(str, line)))
+        if ctids:
+            ctids.pop()
+        else:
+            added.append(line)
+
+    # Slot: ctids of rows that are not in the new lines
+    removed: dict[tuple[str, str, str], list[CTID]] = {}
+    for line, ctids in unmatched.items():
+        removed.setdefault(line_slot(line), []).extend(ctids)
+
+    inserts, updates = [], []
+    for line in added:
+        ctids = removed.get(line_slot(line))
+        if ctids:
+            updates.append((ctids.pop(), line))
+        else:
+            inserts.append(line)
+
+    deletes = [ctid for ctids in removed.values() for ctid in ctids]
+
+    return inserts, updates, deletes
+
+
+class ScheduleWriter:
+    """Applies parsed lines to group tables, writing them row by row or in bulk.
+    Table names are quoted identifiers like the bot reads them, so `KM41` or `km-41` work"""
+    MODES = ("row", "values", "copy")
+
+    def __init__(self, cursor, mode: str = "values") -> None:
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown ingest mode: {mode}, expected one of {self.MODES}")
+
+        self.cursor = cursor
+        self.mode = mode
+
+    def sync_range(self, group, week, lines: list[LINE]) -> Counter:
+        self.cursor.execute(sql.SQL("""
+        SELECT ctid, {}
+        FROM {}
+        WHERE week = %s
+        """).format(LINE_COLUMNS, sql.Identifier(group)), (week,))
+        existing = [(row[0], row[1:]) for row in self.cursor.fetchall()]
+
+        inserts, updates, deletes = diff_lines(existing, lines)
+
+        self.delete_rows(group, deletes)
+        for ctid, line in updates:
+            self.update_data(group, ctid, line)
+        self.insert_lines(group, inserts)
+
+        return Counter(inserted=len(inserts), updated=len(updates), deleted=len(deletes))
+
+    def insert_lines(self, group, lines: list[LINE]) -> None:
+        if not lines:
+            return
+
+        if self.mode == "row":
+            for line in lines:
+                self.insert_data(group, line)
+
+        elif self.mode == "values":
+            query = sql.SQL("INSERT INTO {} ({}) VALUES %s").format(sql.Identifier(group), LINE_COLUMNS)
+            execute_values(self.cursor, query, lines, page_size=1000)
+
+        else:
+            buffer = io.StringIO()
+            # Quoting keeps empty strings from being read as NULL
+            csv.writer(buffer, quoting=csv.QUOTE_ALL).writerows(lines)
+            buffer.seek(0)
+            query = sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT csv)").format(sql.Identifier(group), LINE_COLUMNS)
+            self.cursor.copy_expert(query.as_string(self.cursor), buffer)
+
+    def delete_rows(self, group, ctids: list[CTID]) -> None:
+        if not ctids:
+            return
+
+        if self.mode == "row":
+            for ctid in ctids:
+                self.cursor.execute(sql.SQL("DELETE FROM {} WHERE ctid = %s").format(sql.Identifier(group)), (ctid,))
+        else:
+            self.cursor.execute(sql.SQL("DELETE FROM {} WHERE ctid = ANY(%s::tid[])").format(sql.Identifier(group)),
+                                (ctids,))
+
+    def insert_data(self, group, line) -> None:
+        query = sql.SQL("""
+        INSERT INTO {} (day_of_week, time, subject, class_type, week, url)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        """).format(sql.Identifier(group))
+        self.cursor.execute(query, line)
+
+    def update_data(self, group, ctid: CTID, line) -> None:
+        "Updates stay per row in every mode, they only happen to edited slots"
+        query = sql.SQL("""
+        UPDATE {}
+        SET day_of_week = %s, time = %s, subject = %s, class_type = %s, week = %s, url = %s
+        WHERE ctid = %s
+        """).format(sql.Identifier(group))
+        self.cursor.execute(query, (*line, ctid))
+
+
+class TokenManager:
+    """Keeps the service account token fresh. Refreshes run in a thread
+    `refresh_margin` seconds ahead of expiry, so requests never wait for them"""
+    def __init__(self, credentials: "service_account.Credentials", logger: logging.Logger,
+                 refresh_margin: float = 5*60, retry_interval: float = 30) -> None:
+        self.credentials = credentials
+        self.logger = logger
+        self.refresh_margin = refresh_margin
+        self.retry_interval = retry_interval
+        self._lock = asyncio.Lock()
+
+    def seconds_left(self) -> float:
+        if self.credentials.token is None or self.credentials.expiry is None:
+            return 0
+        # google-auth keeps expiry as naive UTC
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        return (self.credentials.expiry - now).total_seconds()
+
+    async def refresh(self) -> None:
+        async with self._lock:
+            # Somebody else may have refreshed it while we waited
+            if self.seconds_left() > self.refresh_margin:
+                return
+            from google.auth.transport.requests import Request
+            await asyncio.to_thread(self.credentials.refresh, Request())
+        self.logger.info(f"Data fetcher service: Token refreshed, valid for {self.seconds_left()/60:.0f}minutes")
+
+    async def headers(self) -> dict[str, str]:
+        # Only waits if the background refresh fell behind
+        if self.seconds_left() <= 0:
+            await self.refresh()
+        return {"Authorization": f"Bearer {self.credentials.token}"}
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(max(self.seconds_left() - self.refresh_margin, 0))
+            try:
+                await self.refresh()
+            except Exception as e:
+                self.logger.warning(f"Data fetcher service: Token refresh failed, retrying in {self.retry_interval}seconds: {e}")
+                await asyncio.sleep(self.retry_interval)
+
+
 class ScheduleDataFetcherService:
     def __init__(self, setup_data: SetupServiceData) -> None:
         self.setup_data = setup_data
+        self.config = load_fetcher_config()
+        self.groups: list[Group] = load_groups()
+        # Spawned like the worker process it may run in, forking a process with running threads isn't safe
+        self.parse_pool = ProcessPoolExecutor(max_workers=self.config["parse_workers"],
+                                              mp_context=multiprocessing.get_context("spawn"))
+        # (group, week): hash of the last applied value range
+        self.range_hashes: dict[tuple[str, int], str] = {}
+        # Drive file version of the last applied spreadsheet, None until the first run
+        self.sheet_version: str | None = None
+        self.poll_interval = self.config["min_poll_interval"]
+        # Connected in `setup`
+        self.http: httpx.AsyncClient | None = None
+        self.tokens: TokenManager | None = None
+        self.db_connection = None
+
+    async def setup(self) -> None:
+        "Google API and database are connected concurrently"
+        self.setup_data.logger.info("Data fetcher service: Starting")
+        timer = StartupTimer()
+
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(timer.time("google_api", self.connect_google_api()))
+            tg.create_task(timer.time("db", asyncio.to_thread(self.setup_db_connection)))
 
-        self.setup_google_api_connection()
-        self.setup_db_connection()
+        self.setup_data.logger.info(f"Data fetcher service: Started in {timer.report()}")
+
+    async def connect_google_api(self) -> None:
+        await asyncio.to_thread(self.setup_google_api_connection)
+        if self.tokens is not None:
+            await self.tokens.refresh()
 
     def setup_google_api_connection(self) -> None:
-        self.spreadsheet_id = "1gsxm1onrT76UYZxuT7b-qyO-haWiWk7igKwvSB0LLbg"
+        self.spreadsheet_id = self.config["spreadsheet_id"]
         scopes = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive", "https://www.googleapis.com/auth/spreadsheets"]
-
-        self.credentials = service_account.Credentials.from_service_account_file("./data/StudentBot/schedule_file_api_creds.json", scopes=scopes)
-        self.credentials.refresh(Request())
         
-        self.url = f"https://sheets.googleapis.com/v4/spreadsheets/{self.spreadsheet_id}/values:batchGet"
-        self.params = {
-            "ranges": [
-                "KM31!A3:E32", "KM31!G3:K32",
-                "KM32!A3:E32", "KM32!G3:K32",
-                "KM33!A3:E32", "KM33!G3:K32",
-            ]
-        }
-        self.headers = {
-            "Authorization": f"Bearer {self.credentials.token}"
-        }
+        self.url = f"{self.config['sheets_api_url']}/v4/spreadsheets/{self.spreadsheet_id}/values:batchGet"
+        # Only metadata, much cheaper than pulling all the values
+        self.version_url = f"{self.config['drive_api_url']}/drive/v3/files/{self.spreadsheet_id}"
+        # ((group, week), sheet range) of every group in the registry
+        self.ranges = [
+            ((group.name, week), sheet_range)
+            for group in self.groups
+            for week, sheet_range in group.sheet_ranges().items()
+        ]
+
+        # Kept for the whole run, connections are reused between polls.
+        # HTTP/2 needs the optional `h2` package
+        self.http = httpx.AsyncClient(
+            http2=importlib.util.find_spec("h2") is not None,
+            timeout=httpx.Timeout(30),
+            limits=httpx.Limits(max_keepalive_connections=4, keepalive_expiry=15*60),
+        )
+
+        if self.config["credentials_file"] is None:
+            self.tokens = None
+            return
+
+        from google.oauth2 import service_account
+        credentials = service_account.Credentials.from_service_account_file(self.config["credentials_file"], scopes=scopes)
+        # First refresh happens in `setup`
+        self.tokens = TokenManager(credentials, self.setup_data.logger)
      
     def setup_db_connection(self) -> None:
         self.db_connection = psycopg2.connect(
@@ -75,53 +336,141 @@ class ScheduleDataFetcherService:
         )
 
         self.db_cursor = self.db_connection.cursor()
+        self.writer = ScheduleWriter(self.db_cursor, self.config["ingest_mode"])
 
     async def run(self) -> None:
-        self.setup_data.logger.info("Data fetcher service: Starting")
+        token_refresher = None
         
         try:
+            if self.tokens is not None:
+                token_refresher = asyncio.create_task(self.tokens.run())
+
             while True:
                 await self.mainloop()
         except Exception as e:
             self.setup_data.logger.exception(f"Data fetcher service: {e}")
+        finally:
+            if token_refresher is not None:
+                token_refresher.cancel()
+
+    async def shutdown(self) -> None:
+        if self.http is not None:
+            await self.http.aclose()
+        if self.db_connection is not None:
+            self.db_connection.close()
+        self.parse_pool.shutdown(cancel_futures=True)
 
     async def mainloop(self) -> None:
         time_before_parsing = perf_counter()
 
-        self.db_cursor.execute("DELETE FROM km31")
-        self.db_cursor.execute("DELETE FROM km32")
-        self.db_cursor.execute("DELETE FROM km33")
+        version = await self.fetch_version()
+        if version is not None and version == self.sheet_version:
+            self.back_off()
+            self.setup_data.logger.debug(f"Data fetcher service: Spreadsheet unchanged, next check in {self.poll_interval}seconds")
+            await asyncio.sleep(self.poll_interval)
+            return
         
-        self.setup_data.logger.info("Data fetcher service: Fetching data")
-        info = await self.fetch_data()
+        self.setup_data.logger.info(f"Data fetcher service: Fetching {len(self.ranges)} ranges of {len(self.groups)} groups")
+        value_ranges = await self.fetch_data()
         self.setup_data.logger.info("Data fetcher service: Parsing data")
-        self.parse(info)
-        self.db_connection.commit()
+        changes = await self.parse(value_ranges)
 
-        self.setup_data.logger.info(f"Data fetcher service: Done in {perf_counter()-time_before_parsing:.2f}seconds")
+        self.setup_data.logger.info(f"Data fetcher service: Done in {perf_counter()-time_before_parsing:.2f}seconds, "
+                                    f"{changes['inserted'] + changes['updated'] + changes['deleted']} rows changed "
+                                    f"({changes['inserted']} inserted, {changes['updated']} updated, {changes['deleted']} deleted), "
+                                    f"{changes['unchanged_ranges']} of {changes['ranges']} ranges unchanged")
 
-        await asyncio.sleep(5*60)
+        self.sheet_version = version
+        if changes["unchanged_ranges"] < changes["ranges"]:
+            # More edits usually follow the first one
+            self.poll_interval = self.config["min_poll_interval"]
+        else:
+            # Also when the version can't be checked, every poll would be a full fetch otherwise
+            self.back_off()
+        await asyncio.sleep(self.poll_interval)
 
-    def parse(self, info) -> None:
-        for group_number, group in enumerate(("km31", "km32", "km33")):
-            for week in (1, 2):
-                batch_id = group_number*2 + week-1
-                data = info["valueRanges"][batch_id]["values"]
+    def back_off(self) -> None:
+        self.poll_interval = min(self.poll_interval * self.config["poll_backoff"], self.config["max_poll_interval"])
 
-                for line in parse_range(data, week=week):
-                    self.insert_data(group, line)
+    async def parse(self, value_ranges: dict[tuple[str, int], list[list[str]]]) -> Counter:
+        """Parses value ranges in the worker pool and applies changed ones to the tables
+        in one transaction. Returns counts of inserted, updated, deleted rows and unchanged_ranges of all ranges"""
+        loop = asyncio.get_running_loop()
+        keys = list(value_ranges)
+        prepared = await asyncio.gather(*(
+            loop.run_in_executor(self.parse_pool, prepare_range, value_ranges[key], key[1], self.range_hashes.get(key))
+            for key in keys
+        ))
 
-    def insert_data(self, group, line) -> None:
-        query = f"""
-        INSERT INTO {group} (day_of_week, time, subject, class_type, week, url)
-        VALUES (%s, %s, %s, %s, %s, %s)
-        """
-        self.db_cursor.execute(query, line)
-        pass
+        changes = Counter(ranges=len(keys))
+        # Committed together with the rows
+        new_hashes = {}
+
+        try:
+            for (group, week), (range_hash, lines) in zip(keys, prepared):
+                if lines is None:
+                    changes["unchanged_ranges"] += 1
+                    continue
+
+                changes += self.writer.sync_range(group, week, lines)
+                new_hashes[group, week] = range_hash
+
+            if new_hashes:
+                # Delivered to the listening bots once the transaction commits, never before
+                changed_groups = sorted({group for group, _ in new_hashes})
+                self.db_cursor.execute("SELECT pg_notify(%s, %s)", (SCHEDULE_CHANNEL, json.dumps(changed_groups)))
+            self.db_connection.commit()
+        except Exception:
+            self.db_connection.rollback()
+            raise
+
+        self.range_hashes.update(new_hashes)
+        return changes
+
+    async def headers(self) -> dict[str, str]:
+        if self.tokens is None:
+            return {}
+        return await self.tokens.headers()
+
+    async def fetch_version(self) -> str | None:
+        "Returns None if the version is unknown, values have to be fetched then"
+        response = await self.http.get(self.version_url, params={"fields": "version,modifiedTime"}, headers=await self.headers())
+
+        if response.status_code != 200:
+            self.setup_data.logger.warning(f"Data fetcher service: Failed to check spreadsheet version ({response.status_code})")
+            return None
+
+        return response.json().get("version")
+
+    async def fetch_data(self) -> dict[tuple[str, int], list[list[str]]]:
+        "Returns values of every range by (group, week), fetched in concurrent shards"
+        shard_size = self.config["shard_size"]
+        shards = [self.ranges[i:i+shard_size] for i in range(0, len(self.ranges), shard_size)]
+        semaphore = asyncio.Semaphore(self.config["fetch_concurrency"])
+
+        async def fetch_shard(shard):
+            async with semaphore:
+                return await self.fetch_ranges([sheet_range for _, sheet_range in shard])
+
+        results = await asyncio.gather(*(fetch_shard(shard) for shard in shards))
+
+        value_ranges = {}
+        for shard, data in zip(shards, results):
+            # batchGet keeps the order of requested ranges
+            for (key, _), value_range in zip(shard, data["valueRanges"], strict=True):
+                value_ranges[key] = value_range.get("values", [])
+
+        return value_ranges
+
+    async def fetch_ranges(self, ranges: list[str]) -> dict:
+        response = await self.http.get(self.url, params={"ranges": ranges}, headers=await self.headers())
+        response.raise_for_status()
+        data = response.json()
+
+        return data
 
-    async def fetch_data(self):
-        async with httpx.AsyncClient() as client:
-            response = await client.get(self.url, params=self.params, headers=self.headers)
-            data = response.json()
 
-            return data
+def run_worker(logger: logging.Logger) -> None:
+    "Runs the service in a worker process, see `workers.WorkerProcess`"
+    service = ScheduleDataFetcherService(SetupServiceData(logger=logger, shared={}))
+    asyncio.run(serve(service))
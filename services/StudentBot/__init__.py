@@ -1,22 +1,61 @@
-from typing import Any
-from service_setup import SetupServiceData, get_token
-from telegram.ext import ApplicationBuilder, CommandHandler
+from typing import Any, Awaitable, Callable, Hashable, get_args, get_type_hints
+from collections import Counter
+from service_setup import SCHEDULE_CHANNEL, SetupServiceData, get_token, load_groups
+from outbound import MeasuredRequest, OutboundScheduler, Priority
+from webhook import start_updates, stop_updates
+from journal import JournaledStore, delete_entry, set_entry
+from dispatch import PerUserUpdateProcessor, update_user
+from lifecycle import StartupTimer
+import metrics
+from telegram.ext import Application, ApplicationBuilder, CommandHandler
 import telegram
 import asyncio
 from telegram.ext import CallbackQueryHandler, MessageHandler, CallbackContext, filters
 from telegram import InlineKeyboardButton
-import psycopg2
-
-from dataclasses import dataclass
-import yaml
+import psycopg
+from psycopg import sql
+from psycopg_pool import AsyncConnectionPool
+from cachetools import Cache, TTLCache
+
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from functools import partial
+import datetime
+import inspect
 import re
 import json
+import os
+
+HANDLER_SECONDS = metrics.Histogram("studentbot_handler_seconds", "Time to handle an update", ("handler",))
+HANDLER_ERRORS = metrics.Counter("studentbot_handler_errors_total", "Updates whose handler raised", ("handler",))
+BUTTON_SECONDS = metrics.Histogram("studentbot_button_seconds", "Time of Button actions", ("button",))
+QUERY_SECONDS = metrics.Histogram("studentbot_db_query_seconds", "Database query time, waiting for a pooled connection included",
+                                  ("database", "query"))
+
 
 def load_db_config(filename='./data/Scheduler/stud_db_config.json'):
     with open(filename, 'r') as file:
         return json.load(file)
 
 
+def split_db_config(config: dict) -> tuple[dict, dict, dict]:
+    """Split database config into psycopg connection kwargs, pool and cache settings.
+    `database` is renamed to `dbname` as psycopg 3 only knows the libpq name."""
+    config = dict(config)
+    pool_config = {
+        "min_size": config.pop("pool_min_size", 2),
+        "max_size": config.pop("pool_max_size", 10),
+    }
+    cache_config = {
+        "maxsize": config.pop("cache_maxsize", 16384),
+        "ttl": config.pop("cache_ttl", 600),
+    }
+    if "database" in config:
+        config["dbname"] = config.pop("database")
+    return config, pool_config, cache_config
+
+
 def load_schedule_db(filename='./data/Scheduler/schedule_db_config.json'):
     with open(filename, 'r') as file:
         return json.load(file)
@@ -43,6 +82,44 @@ async def delete_user_request_if_text(update: telegram.Update) -> None:
         pass
 
 
+@dataclass
+class FanOutResult:
+    # Key: result of its call
+    results: dict[Hashable, Any] = field(default_factory=dict)
+    # Key: exception raised by its call, TimeoutError for timed out ones
+    failures: dict[Hashable, BaseException] = field(default_factory=dict)
+
+
+async def fan_out(calls: dict[Hashable, Callable[[], Awaitable]], limit: int = 8, timeout: float = 10) -> FanOutResult:
+    """Runs calls concurrently, at most `limit` at a time and each for at most `timeout`
+    seconds. Failed calls don't affect the others, they are collected into `failures`"""
+    semaphore = asyncio.Semaphore(limit)
+    fan_out_result = FanOutResult()
+
+    async def run(key: Hashable, call: Callable[[], Awaitable]) -> None:
+        async with semaphore:
+            try:
+                async with asyncio.timeout(timeout):
+                    fan_out_result.results[key] = await call()
+            except Exception as e:
+                fan_out_result.failures[key] = e
+
+    await asyncio.gather(*(run(key, call) for key, call in calls.items()))
+    return fan_out_result
+
+
+# Column of `students` table: Client attribute storing it, `id` is the first column
+CLIENT_COLUMNS = {
+    "verified": "_verified",
+    "real_name": "_real_name",
+    "group": "_group",
+    "is_inputting_name": "_is_inputting_name",
+    "main_message": "_main_message",
+    "main_message_first": "_main_message_first",
+}
+STUDENT_COLUMNS = ("id", *CLIENT_COLUMNS)
+
+
 @dataclass
 class Client:
     _id: int
@@ -54,6 +131,8 @@ class Client:
     _main_message_first: bool = True
     _options: dict[str, Any] = None
     student_db: Any = None
+    # Column: value, changed by setters and not yet written to the database
+    _dirty: dict[str, Any] = field(default_factory=dict, repr=False)
     
     @property
     def id(self) -> int:
@@ -65,15 +144,7 @@ class Client:
     
     @is_verified.setter
     def is_verified(self, verified: bool) -> None:
-        query = """
-        UPDATE students
-        SET verified = %s
-        WHERE id = %s
-        """
-
-        self.student_db.cursor.execute(query, (verified, self.id))
-        self._verified = verified
-        self.student_db.update_db()
+        self._set("verified", verified)
 
     @property
     def real_name(self) -> str | None:
@@ -81,15 +152,7 @@ class Client:
     
     @real_name.setter
     def real_name(self, real_name: str) -> None:
-        query = """
-        UPDATE students
-        SET real_name = %s
-        WHERE id = %s;  
-        """
-
-        self.student_db.cursor.execute(query, (real_name, self.id))
-        self._real_name = real_name
-        self.student_db.update_db()
+        self._set("real_name", real_name)
 
     @property
     def group(self) -> str | None:
@@ -97,15 +160,7 @@ class Client:
     
     @group.setter
     def group(self, group_name: str) -> None:
-        query = """
-        UPDATE students
-        SET "group" = %s
-        WHERE id = %s;
-        """
-
-        self.student_db.cursor.execute(query, (group_name, self.id))
-        self._group = group_name
-        self.student_db.update_db()
+        self._set("group", group_name)
 
     @property
     def is_inputting_name(self) -> bool:
@@ -113,16 +168,7 @@ class Client:
     
     @is_inputting_name.setter
     def is_inputting_name(self, is_inputting_name: bool) -> None:
-        query = """
-        UPDATE students
-        SET is_inputting_name = %s
-        WHERE id = %s;
-        """
-
-        self.student_db.cursor.execute(query, (is_inputting_name, self.id))
-        self._is_inputting_name = is_inputting_name
-
-        self.student_db.update_db()
+        self._set("is_inputting_name", is_inputting_name)
 
     @property
     def main_message(self) -> int | None:
@@ -130,16 +176,7 @@ class Client:
     
     @main_message.setter
     def main_message(self, main_message_: int) -> None:
-        query = """
-        UPDATE students
-        SET main_message = %s
-        WHERE id = %s;
-        """
-
-        self.student_db.cursor.execute(query, (main_message_, self.id))
-        self._main_message = main_message_
-
-        self.student_db.update_db()
+        self._set("main_message", main_message_)
 
     @property
     def is_main_message_first(self) -> bool:
@@ -147,16 +184,7 @@ class Client:
     
     @is_main_message_first.setter
     def is_main_message_first(self, main_message_first: bool) -> None:
-        query = """
-        UPDATE students
-        SET main_message_first = %s
-        WHERE id = %s;
-        """
-
-        self.student_db.cursor.execute(query, (main_message_first, self.id))
-        self._main_message_first = main_message_first
-
-        self.student_db.update_db()
+        self._set("main_message_first", main_message_first)
 
     @property
     def options(self) -> dict[str, Any] | None:
@@ -166,26 +194,46 @@ class Client:
     def options(self, options: dict[str, Any]) -> None:
         self._options = options
 
+    def _set(self, column: str, value: Any) -> None:
+        setattr(self, CLIENT_COLUMNS[column], value)
+        self._dirty[column] = value
+
+    @property
+    def dirty(self) -> dict[str, Any]:
+        return self._dirty
+
+    async def save(self) -> None:
+        """Writes fields changed through the setters to the database.
+        Inside of `StudentDB.unit_of_work` it is done automatically"""
+        await self.student_db.flush([self])
+
 
 class Admins:
     def __init__(self, service) -> None:
         self.logger = service.logger
         self.groups = service.groups
-        self._admins = self.load_admins()
+        self._store = JournaledStore("data/Scheduler/admins", self.logger)
+        if self._store.created:
+            for group, admins in (self.load_admins() or {}).items():
+                self._store.set((group,), admins)
+        self._admins = self._store.data
 
     def get_admins(self, group: str) -> list[int]:
-        return self._admins[group]
-    
-    def add_admin(self, group: str, user_id: int) -> None:
-        self.logger.info(f"StudentBotService: Added admin {user_id} to group {group}")
-        self._admins[group].append(user_id)
-        self.save_admins()
-
-    def save_admins(self) -> None:
-        with open("data/Scheduler/admins.yaml", "w") as f:
-            yaml.dump(self._admins, f)
+        # Groups added to the registry after the file was saved have no admins yet
+        return self._admins.get(group, [])
     
+    async def add_admin(self, groups: list[str], user_id: int) -> None:
+        await self._store.apply([set_entry((group,), [*self.get_admins(group), user_id]) for group in groups])
+        self.logger.info(f"StudentBotService: Added admin {user_id} to groups {', '.join(groups)}")
+
+    def close(self) -> None:
+        self._store.close()
+
     def load_admins(self) -> dict[str, list[int]]:
+        "Admins saved by older versions, imported into the store once"
+        # Imported here, only a first start after an upgrade needs it
+        import yaml
+
         try:
             with open("data/Scheduler/admins.yaml", "r") as f:
                 return yaml.load(f, Loader=yaml.FullLoader)
@@ -200,50 +248,246 @@ class Admins:
 # Group: {Admin_id: {User_for_verification_id: admin_verification_message_id}}
 ADMIN_VERIFIED_MESSAGES = dict[str, dict[int, dict[int, int]]]
 
+class StatsCache(TTLCache):
+    "TTL cache counting hits, misses and evictions, used for `students` rows and Telegram metadata"
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        super().__init__(maxsize, ttl)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def lookup(self, id: int) -> Any | None:
+        row = self.get(id)
+        if row is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return row
+
+    def popitem(self):
+        item = super().popitem()
+        self.evictions += 1
+        return item
+
+    def expire(self, time=None):
+        # `len` and `currsize` of TTLCache expire items themselves
+        size = Cache.__len__(self)
+        super().expire(time)
+        self.expirations += size - Cache.__len__(self)
+
+    def stats(self) -> dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "size": self.currsize,
+            "maxsize": self.maxsize,
+        }
+
+
+@dataclass
+class UnitOfWork:
+    "State of `StudentDB` for handling one update"
+    # Identity map, None marks a student known to be missing
+    clients: dict[int, Client | None] = field(default_factory=dict)
+    # Student whose updates are ordered with this one, see `StudentDB.set_columns`
+    user: int | None = None
+    selects: int = 0
+    updates: int = 0
+
+
+_unit_of_work: ContextVar[UnitOfWork | None] = ContextVar("unit_of_work", default=None)
+
 
 class StudentDB:
     def __init__(self):
-        self.connection = psycopg2.connect(**load_db_config())
-        self.cursor = self.connection.cursor()
-
-    def add_student(self, id: int) -> Client:
+        connection_config, pool_config, cache_config = split_db_config(load_db_config())
+        # Opened in `open`, pool has to be created inside of a running event loop
+        self.pool = AsyncConnectionPool(kwargs=connection_config, open=False, **pool_config)
+        # Shared by all updates, kept up to date by `write`
+        self.cache = StatsCache(**cache_config)
+        # Totals of "select", "insert", "update" queries and "units_of_work"
+        self.stats = Counter()
+        # Id: writes that started or finished while a SELECT of it ran, only ids being selected
+        self._writes_during_select: dict[int, int] = {}
+        self._selects_in_flight = Counter()
+
+    async def open(self) -> None:
+        await self.pool.open()
+
+    async def add_student(self, id: int) -> Client:
 
         query = """
         INSERT INTO students (id, verified, real_name, "group", is_inputting_name, main_message, main_message_first)
         VALUES (%s, %s, %s, %s, %s, %s, %s) ON CONFLICT (id) DO NOTHING
         """
 
-        self.cursor.execute(query, (id, False, None, None, False, None, True))
-        self.connection.commit()
+        with QUERY_SECONDS.time(database="students", query="insert"):
+            async with self.pool.connection() as connection:
+                cursor = await connection.execute(query, (id, False, None, None, False, None, True))
+        self.stats["insert"] += 1
+
+        if cursor.rowcount == 1:
+            self.cache[id] = (id, False, None, None, False, None, True)
+
+        unit_of_work = _unit_of_work.get()
+        if unit_of_work is not None and unit_of_work.clients.get(id) is not None:
+            return unit_of_work.clients[id]
 
         student = Client(id, student_db=self)
+        if unit_of_work is not None:
+            unit_of_work.clients[id] = student
 
         return student
 
-    def update_student_verification(self, id: int, verified: bool) -> None:
+    async def update_student_verification(self, id: int, verified: bool) -> None:
+        await self.write({id: {"verified": verified}})
+
+    @asynccontextmanager
+    async def unit_of_work(self, user: int | None = None):
+        """Within the unit every student is selected at most once and the same
+        `Client` is returned for them. Changes made by its setters are written on exit,
+        one UPDATE per student in a single transaction. Nested units join the outer one.
+        `user` is the student the handled update is from"""
+        unit_of_work = _unit_of_work.get()
+        if unit_of_work is not None:
+            yield unit_of_work
+            return
 
-        query = """
-        UPDATE students 
-        SET verified = %s
-        WHERE id = %s
-        """
+        unit_of_work = UnitOfWork(user=user)
+        token = _unit_of_work.set(unit_of_work)
+        self.stats["units_of_work"] += 1
+        try:
+            yield unit_of_work
+        finally:
+            _unit_of_work.reset(token)
+            clients = [client for client in unit_of_work.clients.values() if client is not None]
+            unit_of_work.updates = await self.flush(clients)
+
+    async def set_columns(self, client: Client, columns: dict[str, Any]) -> None:
+        """Changes `columns` of `client` like its setters. Rows of students other than the
+        one whose update is handled are written right away, updates of that student run
+        under another lock and a flush at the end of this one would overwrite their changes"""
+        unit_of_work = _unit_of_work.get()
+        if unit_of_work is None or unit_of_work.user in (None, client.id):
+            for column, value in columns.items():
+                client._set(column, value)
+            return
+
+        await self.write({client.id: columns})
+        for column, value in columns.items():
+            setattr(client, CLIENT_COLUMNS[column], value)
+
+    @property
+    def selects_per_update(self) -> float:
+        return self.stats["select"] / max(self.stats["units_of_work"], 1)
+
+    async def flush(self, clients: list[Client]) -> int:
+        "Returns amount of UPDATE queries made"
+        # Student id: {column: value}
+        changes: dict[int, dict[str, Any]] = {}
+        for client in clients:
+            changes.setdefault(client.id, {}).update(client.dirty)
+
+        updates = await self.write(changes)
+
+        for client in clients:
+            client.dirty.clear()
+
+        return updates
+
+    async def write(self, changes: dict[int, dict[str, Any]]) -> int:
+        changes = {id: columns for id, columns in changes.items() if columns}
+        if not changes:
+            return 0
+
+        self._mark_written(changes)
+        try:
+            with QUERY_SECONDS.time(database="students", query="update"):
+                async with self.pool.connection() as connection:
+                    for id, columns in changes.items():
+                        await connection.execute(self._update_query(columns), (*columns.values(), id))
+        except Exception:
+            for id in changes:
+                self.cache.pop(id, None)
+            raise
+        finally:
+            self._mark_written(changes)
+        self.stats["update"] += len(changes)
+
+        for id, columns in changes.items():
+            self._update_cached(id, columns)
+
+        return len(changes)
+
+    async def write_many(self, ids: list[int], columns: dict[str, Any]) -> None:
+        "Sets the same `columns` of every student in `ids` with one UPDATE"
+        if not ids or not columns:
+            return
+
+        self._mark_written(ids)
+        try:
+            with QUERY_SECONDS.time(database="students", query="update_many"):
+                async with self.pool.connection() as connection:
+                    await connection.execute(self._update_query(columns, sql.SQL("id = ANY(%s)")), (*columns.values(), ids))
+        except Exception:
+            for id in ids:
+                self.cache.pop(id, None)
+            raise
+        finally:
+            self._mark_written(ids)
+        self.stats["update"] += 1
+
+        for id in ids:
+            self._update_cached(id, columns)
+
+    def _mark_written(self, ids) -> None:
+        "Called when a write starts and when it ends, SELECTs running meanwhile may have read the old row"
+        for id in ids:
+            if id in self._writes_during_select:
+                self._writes_during_select[id] += 1
 
-        self.cursor.execute(query, (verified, id))
-        self.connection.commit()
+    def _update_cached(self, id: int, columns: dict[str, Any]) -> None:
+        cached = self.cache.get(id)
+        if cached is not None:
+            row = dict(zip(STUDENT_COLUMNS, cached))
+            row.update(columns)
+            self.cache[id] = tuple(row.values())
 
-    def get_student(self, id: int) -> Client | None:
+    @staticmethod
+    def _update_query(columns: dict[str, Any], where: sql.SQL = sql.SQL("id = %s")) -> sql.Composed:
+        for column in columns:
+            if column not in CLIENT_COLUMNS:
+                raise ValueError(f"Unknown students column: {column}")
+
+        assignments = sql.SQL(", ").join(
+            sql.SQL("{} = %s").format(sql.Identifier(column)) for column in columns)
+
+        return sql.SQL("""
+        UPDATE students
+        SET {}
+        WHERE {}
+        """).format(assignments, where)
+
+    async def get_student(self, id: int) -> Client | None:
         """Return tuple with information about student:
         (id, verified, real_name, group, is_inputting_name, main_message)"""
 
-        query = """
-        SELECT * FROM students
-        WHERE id = %s
-        """
+        unit_of_work = _unit_of_work.get()
+        if unit_of_work is not None and id in unit_of_work.clients:
+            return unit_of_work.clients[id]
 
-        self.cursor.execute(query, (id,))
-        student_info = self.cursor.fetchone()
+        student_info = self.cache.lookup(id)
+        if student_info is None:
+            student_info = await self._select_student(id)
 
         if student_info is None:
+            if unit_of_work is not None:
+                unit_of_work.clients[id] = None
             return None
 
         student = Client(_id = student_info[0],
@@ -254,30 +498,94 @@ class StudentDB:
                          _main_message = student_info[5],
                          _main_message_first = student_info[6],
                          student_db = self) 
+
+        if unit_of_work is not None:
+            unit_of_work.clients[id] = student
         
         return student
 
-    def student_exist(self, id: int) -> bool:
-        return bool(self.get_student(id))
+    async def _select_student(self, id: int) -> tuple | None:
+        query = """
+        SELECT * FROM students
+        WHERE id = %s
+        """
 
-    def close(self):
-        self.cursor.close()
-        self.connection.close()
+        self._selects_in_flight[id] += 1
+        writes = self._writes_during_select.setdefault(id, 0)
+        try:
+            with QUERY_SECONDS.time(database="students", query="select"):
+                async with self.pool.connection() as connection:
+                    cursor = await connection.execute(query, (id,))
+                    student_info = await cursor.fetchone()
+        finally:
+            # The row may be older than what a concurrent write put into the cache
+            written = self._writes_during_select[id] != writes
+            self._selects_in_flight[id] -= 1
+            if not self._selects_in_flight[id]:
+                del self._selects_in_flight[id]
+                del self._writes_during_select[id]
+        self.stats["select"] += 1
+
+        unit_of_work = _unit_of_work.get()
+        if unit_of_work is not None:
+            unit_of_work.selects += 1
+
+        if student_info is not None and not written:
+            self.cache[id] = tuple(student_info)
+
+        return student_info
+
+    async def verified_students(self, group: str, after_id: int, limit: int) -> list[int]:
+        """Ids of verified students of `group` greater than `after_id`, ascending.
+        Pages by the primary key, so each batch costs the same however far in it is"""
+        query = """
+        SELECT id FROM students
+        WHERE verified AND "group" = %s AND id > %s
+        ORDER BY id
+        LIMIT %s
+        """
 
-    def update_db(self) -> None:
-        "We don't know how, but it works!!!"
-        self.add_student(id=0)
+        with QUERY_SECONDS.time(database="students", query="verified_students"):
+            async with self.pool.connection() as connection:
+                cursor = await connection.execute(query, (group, after_id, limit), prepare=True)
+                return [id for id, in await cursor.fetchall()]
+
+    async def student_exist(self, id: int) -> bool:
+        return bool(await self.get_student(id))
+
+    async def close(self):
+        await self.pool.close()
 
 
 class Verification:
+    # Admins messaged at once and seconds to wait for each of them
+    FAN_OUT_LIMIT = 8
+    FAN_OUT_TIMEOUT = 10
+
     def __init__(self, service) -> None:
         self.logger = service.logger
         self.admins = service.admins
         self.groups = service.groups
         self.service = service
-        self._messages = self.load_messages()
-        
+        self._store = JournaledStore("data/Scheduler/request_messages", self.logger)
+        if self._store.created:
+            self._import_messages(self.load_messages() or {})
+        self._messages: ADMIN_VERIFIED_MESSAGES = self._store.data
+
+    def _import_messages(self, messages: ADMIN_VERIFIED_MESSAGES) -> None:
+        for group, admins in messages.items():
+            for admin, requests in admins.items():
+                for user_id, message_id in requests.items():
+                    self._store.set((group, admin, user_id), message_id)
+        self._store.compact()
+
+    def close(self) -> None:
+        self._store.close()
+
     def load_messages(self) -> ADMIN_VERIFIED_MESSAGES:
+        "Requests saved by older versions, imported into the store once"
+        import yaml
+
         try:
             with open("data/Scheduler/request_messages.yaml", "r") as f:
                 return yaml.load(f, Loader=yaml.FullLoader)
@@ -299,21 +607,30 @@ class Verification:
             [InlineKeyboardButton("Discard", callback_data="discard_user")],
         ])
         await self._send_request_to_admins(client, verification_text, reply_markup=reply_markup)
-        self.save_messages()
 
     async def _send_request_to_admins(self, client: Client, text: str, **kwargs):
-        for admin in self.admins.get_admins(client.group):
-            message_id = await self.service.send_raw(admin, text, **kwargs)
-            verification_group = self._messages[client.group]
-            verification_group.setdefault(admin, {})[client.id] = message_id
+        result = await fan_out(
+            {admin: partial(self.service.send_raw, admin, text, priority=Priority.BACKGROUND, **kwargs)
+             for admin in self.admins.get_admins(client.group)},
+            limit=self.FAN_OUT_LIMIT, timeout=self.FAN_OUT_TIMEOUT)
+
+        await self._store.apply([set_entry((client.group, admin, client.id), message_id)
+                                 for admin, message_id in result.results.items()])
+
+        self._report_failures(f"send verification request of {client.id} to", result)
 
-    def save_messages(self):
-        with open("data/Scheduler/request_messages.yaml", "w") as f:
-            yaml.dump(self._messages, f)
+    def _report_failures(self, action: str, result: FanOutResult) -> None:
+        for admin, error in result.failures.items():
+            self.logger.warning(f"StudentBotService: Failed to {action} admin {admin}: {error!r}")
+
+        if result.failures:
+            self.logger.error(f"StudentBotService: Failed to {action} {len(result.failures)} of "
+                              f"{len(result.failures) + len(result.results)} admins")
 
     async def verify(self, client: Client, verifier: Client) -> None:
         self.logger.info(f"StudentBotService: Verified user {client.real_name} [{client.id}] to {client.group}")
-        client.is_verified = True
+        # Verified by an admin, so it's another student's row
+        await self.service.student_db.set_columns(client, {"verified": True})
 
         await self._client_send_verified_message(client)
         await self._send_client_verified_to_admins(client, verifier)
@@ -325,6 +642,7 @@ class Verification:
         await self.service.send(
             client.id,
             "You have been verified!",
+            priority=Priority.BACKGROUND,
             reply_markup=reply_markup
         )
 
@@ -348,6 +666,7 @@ class Verification:
         await self.service.send(
             client.id,
             "Your verification request has been discarded.",
+            priority=Priority.BACKGROUND,
             reply_markup=reply_markup
         )
 
@@ -359,123 +678,617 @@ class Verification:
         await self._admins_edit_message(client, discarded_admin_text)
 
     async def _admins_edit_message(self, client: Client, text: str):
-        for admin in self._messages[client.group]:
-            try:
-                await self.service.app.bot.edit_message_text(
-                    chat_id=admin,
-                    message_id=self._messages[client.group][admin][client.id],
-                    text=text
-                )
-            except telegram.error.BadRequest:
-                pass
+        verification_group = self._messages.get(client.group, {})
+        admins = [admin for admin, messages in verification_group.items() if client.id in messages]
+        result = await fan_out(
+            {admin: partial(self.service.outbound.call, admin,
+                            partial(self.service.app.bot.edit_message_text,
+                                    chat_id=admin, message_id=verification_group[admin][client.id], text=text),
+                            Priority.BACKGROUND)
+             for admin in admins},
+            limit=self.FAN_OUT_LIMIT, timeout=self.FAN_OUT_TIMEOUT)
+
+        self._report_failures(f"edit verification request of {client.id} for", result)
+
+        # Request is answered, its messages won't be edited again
+        await self._store.apply([delete_entry((client.group, admin, client.id)) for admin in admins])
     
-    def get_client_from_verification_message(self, message: telegram.Message):
+    async def get_client_from_verification_message(self, message: telegram.Message):
         user_id = int(re.search(r"\[(\d+)\]", message.text).group(1))
-        client = self.service.student_db.get_student(user_id)
+        client = await self.service.student_db.get_student(user_id)
         return client
 
 
-class ScheduleDB:
-    def __init__(self, stud_bot):
-        self.connection = psycopg2.connect(**load_db_config())
-        self.cursor = self.connection.cursor()
-        self.stud_bot = stud_bot
-        self.student_db = self.stud_bot.student_db
+# (group, day, week): rendered schedule message
+RENDERED_SCHEDULES = dict[tuple[str, str, int], str]
 
-    def get_schedule(self, group_name: str, day: str, week: int) -> list:
-        conn = psycopg2.connect(**load_schedule_db())
-        cur = conn.cursor()
-        table_with_links = ''.join(f"{group_name}_links")
 
-        query = f"""
-            SELECT s.time, s.subject, s.class_type, l.url
-            FROM {group_name} AS s
-            JOIN {table_with_links} l ON s.link_id = l.link_id
-            WHERE s.day_of_week = %s AND s.week = %s;
-            """
+def start_time_key(start_time: str) -> tuple[int, int, str]:
+    "Sorts times like \"8:30\" before \"10:25\", text comparison wouldn't. Unparsable ones go last"
+    match = re.match(r"\s*(\d{1,2})[:.](\d{2})", start_time or "")
+    if match is None:
+        return 24, 0, start_time or ""
+    return int(match.group(1)), int(match.group(2)), start_time
 
-        try:
-            cur.execute(query, (day, week))
-            rows = cur.fetchall()
-        except Exception as e:
-            print(f"Database error: {e}")
-            rows = []
-        finally:
-            cur.close()
-            conn.close()
 
-        return rows
+def render_schedule(day: str, rows: list[tuple]) -> str:
+    "Rows are (time, subject, class_type, url)"
+    schedule_info = []
+    for start_time, subject, class_type, link in rows:
+        schedule_info.append(
+            f"{start_time}: {subject}, ({class_type}) [{link}]\n"
+        )
+
+    schedule_text = "\n".join(schedule_info)
+    return f"Schedule for {day}:\n{schedule_text}"
+
+
+def _semester_start(on: datetime.date) -> datetime.date:
+    "Last September 1 or February 1 not after `on`"
+    if on.month >= 9:
+        return datetime.date(on.year, 9, 1)
+    if on.month >= 2:
+        return datetime.date(on.year, 2, 1)
+    return datetime.date(on.year - 1, 9, 1)
+
+
+@dataclass(frozen=True)
+class Semester:
+    "Schedule weeks go 1, 2, ..., `weeks` and start over, counted from the week of `start`"
+    # None is the last September 1 or February 1
+    start: datetime.date | None = None
+    weeks: int = 2
+
+    def week(self, on: datetime.date) -> int:
+        start = self.start or _semester_start(on)
+        first_monday = start - datetime.timedelta(days=start.weekday())
+        return (on - first_monday).days // 7 % self.weeks + 1
+
 
-    async def send_schedule(self, update: telegram.Update, user_id: int, context: CallbackContext, day: str) -> None:
+def load_semester(filename='./data/Scheduler/semester.json') -> Semester:
+    """`{"start": "2026-09-01", "weeks": 2}`, the default Semester if the file doesn't exist"""
+    try:
+        with open(filename, 'r') as file:
+            semester = json.load(file)
+    except FileNotFoundError:
+        return Semester()
+
+    return Semester(start=datetime.date.fromisoformat(semester["start"]), weeks=semester.get("weeks", 2))
+
+
+class ScheduleDB:
+    # Seconds before listening again after the notification connection failed
+    LISTEN_RETRY = 10
+
+    def __init__(self, stud_bot, refresh_interval: float = 5*60):
+        connection_config, pool_config, _ = split_db_config(load_schedule_db())
+        # Opened in `open`, like the pool of StudentDB
+        self.pool = AsyncConnectionPool(kwargs=connection_config, open=False, **pool_config)
+        # `listen` holds its own connection, a pooled one would be returned between notifications
+        self.connection_config = connection_config
+        self.stud_bot = stud_bot
+        self.logger = stud_bot.logger
+        self.student_db = self.stud_bot.student_db
+        # Schedule changes at most as often as ScheduleDataFetcherService runs
+        self.refresh_interval = refresh_interval
+        # Replaced as a whole by `refresh`, never modified in place
+        self._rendered: RENDERED_SCHEDULES = {}
+        self.semester = load_semester()
+
+    async def open(self) -> None:
+        await self.pool.open()
+
+    async def close(self) -> None:
+        await self.pool.close()
+
+    async def get_group_schedule(self, group_name: str) -> list[tuple]:
+        "Returns (day_of_week, week, time, subject, class_type, url) rows of the group"
+        table_with_links = f"{group_name}_links"
+
+        query = sql.SQL("""
+            SELECT s.day_of_week, s.week, s.time, s.subject, s.class_type, l.url
+            FROM {} AS s
+            JOIN {} l ON s.link_id = l.link_id;
+            """).format(sql.Identifier(group_name), sql.Identifier(table_with_links))
+
+        with QUERY_SECONDS.time(database="schedule", query="group_schedule"):
+            async with self.pool.connection() as connection:
+                # Prepared once per pooled connection, later calls only bind and execute
+                cursor = await connection.execute(query, prepare=True)
+                return await cursor.fetchall()
+
+    async def refresh(self) -> None:
+        "Renders schedule messages of every group and swaps them in at once"
+        rendered: RENDERED_SCHEDULES = {}
+
+        for group_name in self.stud_bot.groups:
+            try:
+                rows = await self.get_group_schedule(group_name)
+            except Exception as e:
+                self.logger.exception(f"StudentBotService: Failed to load schedule of {group_name}, keeping the old one: {e}")
+                rendered.update({key: text for key, text in self._rendered.items() if key[0] == group_name})
+                continue
+
+            # (day, week): [(time, subject, class_type, url)]
+            days: dict[tuple[str, int], list[tuple]] = {}
+            for day, week, *row in rows:
+                days.setdefault((day, week), []).append(tuple(row))
+
+            for (day, week), day_rows in days.items():
+                # Rows come back in no particular order, an updated row moves to the end of the table
+                day_rows.sort(key=lambda row: start_time_key(row[0]))
+                rendered[group_name, day, week] = render_schedule(day, day_rows)
+
+        self._rendered = rendered
+        self.logger.info(f"StudentBotService: Schedule cache refreshed, {len(rendered)} messages")
+
+    async def refresh_periodically(self) -> None:
+        "Catches up with changes whose notification got lost"
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            await self.refresh()
+
+    async def listen(self) -> None:
+        "Refreshes as soon as ScheduleDataFetcherService commits schedule changes"
+        changed = asyncio.Event()
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(self._refresh_on(changed))
+            reconnecting = False
+
+            while True:
+                try:
+                    async with await psycopg.AsyncConnection.connect(**self.connection_config, autocommit=True) as connection:
+                        await connection.execute(sql.SQL("LISTEN {}").format(sql.Identifier(SCHEDULE_CHANNEL)))
+                        if reconnecting:
+                            # Changes committed while nobody listened
+                            changed.set()
+                        reconnecting = True
+
+                        async for notify in connection.notifies():
+                            self.logger.debug(f"StudentBotService: Schedule of {notify.payload} changed")
+                            changed.set()
+                except psycopg.Error as e:
+                    self.logger.warning(f"StudentBotService: Lost schedule notifications, listening again in "
+                                        f"{self.LISTEN_RETRY}s: {e!r}")
+                    reconnecting = True
+                    await asyncio.sleep(self.LISTEN_RETRY)
+
+    async def _refresh_on(self, changed: asyncio.Event) -> None:
+        # Notifications arriving during a refresh are handled by one more refresh
+        while True:
+            await changed.wait()
+            changed.clear()
+            await self.refresh()
+
+    def get_rendered_schedule(self, group_name: str, day: str, week: int) -> str | None:
+        return self._rendered.get((group_name, day, week))
+
+    def get_rendered_week(self, group_name: str, week: int) -> str | None:
+        "Every day of the week in one message, None if the week has no schedule"
+        days = [self._rendered.get((group_name, day, week)) for day in WEEKDAYS]
+        days = [text for text in days if text is not None]
+        return "\n\n".join(days) if days else None
+
+    async def send_schedule(self, update: telegram.Update, user_id: int, context: CallbackContext, day: str,
+                            week: int | None = None) -> None:
+        "Current week's schedule unless `week` is given"
         user = update.effective_user
-        client = self.student_db.get_student(user.id)
-        week = self.get_week()
+        client = await self.student_db.get_student(user.id)
+        if week is None:
+            week = self.get_week()
 
-        if not self.student_db.student_exist(user_id):
+        if client is None or client.group is None:
             await self.stud_bot.send(user.id, "You need to register and select a group first.")
             return
 
-        schedule = self.get_schedule(client.group, day, week)
+        schedule_text = self.get_rendered_schedule(client.group, day, week)
 
-        if not schedule:
+        if schedule_text is None:
             await self.stud_bot.send(user.id, f"No schedule found for {day}.")
         else:
-            schedule_info = []
-            for row in schedule:
-                start_time = row[0]
-                subject = row[1]
-                class_type = row[2]
-                link = row[3]
-                schedule_info.append(
-                    f"{start_time}: {subject}, ({class_type}) [{link}]\n"
-                )
-
-            schedule_text = "\n".join(schedule_info)
             try:
-                await self.stud_bot.send(user.id, f"Schedule for {day}:\n{schedule_text}")
+                await self.stud_bot.send(user.id, schedule_text)
             except Exception as e:
                 print(f"Error sending schedule: {e}")
+
+    async def send_week(self, update: telegram.Update, week: int | None = None) -> None:
+        "Current week unless `week` is given, sent as one message"
+        user = update.effective_user
+        client = await self.student_db.get_student(user.id)
+        if week is None:
+            week = self.get_week()
+
+        if client is None or client.group is None:
+            await self.stud_bot.send(user.id, "You need to register and select a group first.")
+            return
+
+        schedule_text = self.get_rendered_week(client.group, week)
+        await self.stud_bot.send(user.id, schedule_text or f"No schedule found for week {week}.")
     
     def get_group_name(self, update: telegram.Update) -> str:
         return self.clients[update.effective_user.id].group
     
-    # TODO
-    def get_week(self):
-        return 1
+    def get_week(self, on: datetime.date | None = None) -> int:
+        "Week of the schedule `on` is in, today by default"
+        return self.semester.week(on or datetime.date.today())
+
+
+class TelegramMetadata:
+    """Names of users and member counts of chats. Both are taken from incoming updates,
+    the Bot API is only asked on a miss"""
+    # A private chat is the user and the bot
+    PRIVATE_CHAT_MEMBERS = 2
+
+    def __init__(self, service, maxsize: int = 16384, name_ttl: float = 24*60*60, member_count_ttl: float = 60*60) -> None:
+        self.service = service
+        self.names = StatsCache(maxsize, name_ttl)
+        self.member_counts = StatsCache(maxsize, member_count_ttl)
+
+    def remember(self, update: telegram.Update) -> None:
+        user = update.effective_user
+        if user is not None:
+            self.names[user.id] = user.name
+
+        chat = update.effective_chat
+        if chat is not None and chat.type == telegram.Chat.PRIVATE:
+            self.member_counts[chat.id] = self.PRIVATE_CHAT_MEMBERS
+
+    async def name(self, usr_id: int) -> str:
+        name = self.names.lookup(usr_id)
+        if name is None:
+            member = await self.service.outbound.call(usr_id, partial(self.service.app.bot.get_chat_member, usr_id, usr_id))
+            name = self.names[usr_id] = member.user.name
+        return name
+
+    async def member_count(self, chat: telegram.Chat) -> int:
+        count = self.member_counts.lookup(chat.id)
+        if count is None:
+            count = self.member_counts[chat.id] = await chat.get_member_count()
+        return count
+
+
+# Weekday names used by the schedule, `datetime.date.weekday()` indexed
+WEEKDAYS = ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday")
+# Days relative to today: days ahead
+RELATIVE_DAYS = {"today": 0, "tomorrow": 1}
+# Days of the schedule menu: button title
+DAY_TITLES = {"Monday": "Понеділок", "Tuesday": "Вівторок", "Wednesday": "Середа", "Thursday": "Четвер", "Friday": "П'ятниця"}
+
+
+@dataclass(frozen=True)
+class BroadcastJob:
+    "Schedule of `day` sent every day at `at` to verified students of `groups`"
+    name: str
+    groups: tuple[str, ...]
+    at: datetime.time
+    # "today" or "tomorrow", relative to the day it is sent on
+    day: str = "tomorrow"
+
+    def schedule_date(self, sent_on: datetime.date) -> datetime.date:
+        return sent_on + datetime.timedelta(days=RELATIVE_DAYS[self.day])
+
+
+def load_broadcasts(filename='./data/Scheduler/broadcasts.json') -> list[BroadcastJob]:
+    """`[{"name", "groups", "at": "20:00", "day": "tomorrow"}]`, no broadcasts
+    if the file doesn't exist"""
+    try:
+        with open(filename, 'r') as file:
+            jobs = json.load(file)
+    except FileNotFoundError:
+        return []
+
+    for job in jobs:
+        if job.get("day", "tomorrow") not in RELATIVE_DAYS:
+            raise ValueError(f"Broadcast {job['name']} has day {job['day']}, expected one of {tuple(RELATIVE_DAYS)}")
+
+    return [
+        BroadcastJob(name=job["name"],
+                     groups=tuple(job["groups"]),
+                     at=datetime.time.fromisoformat(job["at"]),
+                     day=job.get("day", "tomorrow"))
+        for job in jobs
+    ]
+
+
+@dataclass
+class BroadcastReport:
+    sent: int = 0
+    failed: int = 0
+    seconds: float = 0
+
+    @property
+    def rate(self) -> float:
+        "Messages sent per second"
+        return self.sent / max(self.seconds, 1e-9)
+
+
+class Broadcast:
+    """Sends one message to every verified student of a group. Recipients are read
+    in batches of BATCH_SIZE, sent in the background lane of the outbound scheduler
+    and the last id of each finished batch is checkpointed, so an interrupted
+    broadcast continues after the last batch instead of starting over"""
+    BATCH_SIZE = 200
+    SEND_TIMEOUT = 60
+    CHECKPOINTS = "data/Scheduler/broadcast_checkpoints.json"
+    # Days checkpoints are kept for
+    CHECKPOINT_DAYS = 2
+
+    def __init__(self, service) -> None:
+        self.logger = service.logger
+        self.service = service
+        self.student_db = service.student_db
+        self.schedule_db = service.schedule_db
+        self.jobs = load_broadcasts()
+        # "<date>/<job>/<group>": {"last_id", "finished", "sent", "failed"}
+        self._checkpoints: dict[str, dict[str, Any]] = self.load_checkpoints()
+        # Jobs run concurrently and share the file
+        self._save_lock = asyncio.Lock()
+
+    def load_checkpoints(self) -> dict[str, dict[str, Any]]:
+        try:
+            with open(self.CHECKPOINTS, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except json.JSONDecodeError as e:
+            self.logger.exception(f"StudentBotService: Failed to load broadcast checkpoints, file is corrupted:\n{e}")
+            return {}
+
+    async def save_checkpoints(self) -> None:
+        oldest = (datetime.date.today() - datetime.timedelta(days=self.CHECKPOINT_DAYS)).isoformat()
+        self._checkpoints = {key: checkpoint for key, checkpoint in self._checkpoints.items() if key >= oldest}
+        # Serialized here, the checkpoints keep changing while the thread writes
+        text = json.dumps(self._checkpoints)
+        async with self._save_lock:
+            await asyncio.to_thread(self._write_checkpoints, text)
+
+    def _write_checkpoints(self, text: str) -> None:
+        "Replaces the file at once, a crash while writing leaves the old checkpoints"
+        temporary_path = f"{self.CHECKPOINTS}.tmp"
+        with open(temporary_path, "w") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, self.CHECKPOINTS)
+
+    async def run(self) -> None:
+        async with asyncio.TaskGroup() as tg:
+            for job in self.jobs:
+                tg.create_task(self.run_daily(job))
+
+    async def run_daily(self, job: BroadcastJob) -> None:
+        while True:
+            run_at = datetime.datetime.combine(datetime.date.today(), job.at)
+            checkpoints = [self._checkpoints.get(self._key(job.name, group, run_at.date())) for group in job.groups]
+            interrupted = any(checkpoint is not None and not checkpoint["finished"] for checkpoint in checkpoints)
+
+            if not interrupted:
+                if datetime.datetime.now() >= run_at:
+                    # Already sent today or started too late for it
+                    run_at += datetime.timedelta(days=1)
+                await asyncio.sleep((run_at - datetime.datetime.now()).total_seconds())
+
+            try:
+                await self.send_job(job, run_at.date())
+            except Exception as e:
+                self.logger.exception(f"StudentBotService: Broadcast {job.name} failed: {e}")
+                # Continues from the checkpoint
+                await asyncio.sleep(self.SEND_TIMEOUT)
+
+    async def send_job(self, job: BroadcastJob, sent_on: datetime.date) -> None:
+        date = job.schedule_date(sent_on)
+        # Tomorrow can be in the next week
+        day, week = WEEKDAYS[date.weekday()], self.schedule_db.get_week(date)
+
+        for group in job.groups:
+            text = self.schedule_db.get_rendered_schedule(group, day, week)
+            if text is None:
+                self.logger.info(f"StudentBotService: Broadcast {job.name} has no schedule of {group} for {day}")
+                continue
+            await self.broadcast(self._key(job.name, group, sent_on), group, text)
+
+    @staticmethod
+    def _key(name: str, group: str, sent_on: datetime.date) -> str:
+        return f"{sent_on.isoformat()}/{name}/{group}"
+
+    async def broadcast(self, key: str, group: str, text: str) -> BroadcastReport:
+        """Sends `text` to verified students of `group`, progress is checkpointed under `key`.
+        Finished broadcasts aren't sent again"""
+        checkpoint = self._checkpoints.setdefault(key, {"last_id": 0, "finished": False, "sent": 0, "failed": 0})
+        report = BroadcastReport()
+        if checkpoint["finished"]:
+            return report
+
+        if checkpoint["last_id"]:
+            self.logger.info(f"StudentBotService: Resuming broadcast {key} after student {checkpoint['last_id']}")
+
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        errors = Counter()
+
+        while ids := await self.student_db.verified_students(group, checkpoint["last_id"], self.BATCH_SIZE):
+            result = await fan_out({id: partial(self._deliver, id, text) for id in ids},
+                                   limit=self.BATCH_SIZE, timeout=self.SEND_TIMEOUT)
+
+            # Broadcast message now is below the main message
+            await self.student_db.write_many(list(result.results), {"main_message_first": False})
+
+            report.sent += len(result.results)
+            report.failed += len(result.failures)
+            errors.update(type(error).__name__ for error in result.failures.values())
+
+            checkpoint.update(last_id=ids[-1], sent=checkpoint["sent"] + len(result.results),
+                              failed=checkpoint["failed"] + len(result.failures))
+            await self.save_checkpoints()
+
+        checkpoint["finished"] = True
+        await self.save_checkpoints()
+
+        report.seconds = loop.time() - started
+        self.logger.info(f"StudentBotService: Broadcast {key} sent to {report.sent} students, "
+                         f"{report.failed} failed {dict(errors)} in {report.seconds:.1f}s ({report.rate:.1f} msg/s)")
+        return report
+
+    async def _deliver(self, usr_id: int, text: str) -> int:
+        message = await self.service.outbound.call(
+            usr_id, partial(self.service.app.bot.send_message, usr_id, text), Priority.BACKGROUND)
+        return message.id
+
+
+@dataclass(frozen=True)
+class Route:
+    "Button action for callback data `name` or `name:arg:...`"
+    name: str
+    action: Callable[..., Awaitable[None]]
+    # Stateless actions skip the student lookup done before the action
+    needs_student: bool = True
+
+
+def _converter(hint: Any) -> Callable[[str], Any]:
+    "Type a callback argument is converted to, `int | None` is `int`"
+    types = [arg for arg in get_args(hint) if arg is not type(None)]
+    return types[0] if types else hint
+
+
+class CallbackRouter:
+    """Routes callback data to Button actions with one dict lookup. Arguments after the
+    route name are converted to the types of the action's parameters after `context`,
+    optional parameters make the route match fewer arguments too"""
+    def __init__(self, routes: list[Route], aliases: dict[str, str]) -> None:
+        # Callback data of older keyboards, still found in chats: current callback data
+        self.aliases = aliases
+        # (name, number of arguments): route and converters of the arguments
+        self._routes: dict[tuple[str, int], tuple[Route, tuple[Callable[[str], Any], ...]]] = {}
+
+        for route in routes:
+            hints = get_type_hints(route.action)
+            # service, update and context come first
+            params = list(inspect.signature(route.action).parameters.values())[3:]
+            converters = tuple(_converter(hints.get(param.name, str)) for param in params)
+            required = sum(param.default is inspect.Parameter.empty for param in params)
+
+            for count in range(required, len(params) + 1):
+                if (route.name, count) in self._routes:
+                    raise ValueError(f"Route {route.name} with {count} arguments is defined twice")
+                self._routes[route.name, count] = (route, converters[:count])
+
+    def resolve(self, data: str) -> tuple[Route, list[Any]] | None:
+        "Route and converted arguments of `data`, None if nothing matches"
+        data = self.aliases.get(data, data)
+        name, *args = data.split(":")
+        found = self._routes.get((name, len(args)))
+        if found is None:
+            return None
+
+        route, converters = found
+        try:
+            return route, [convert(arg) for convert, arg in zip(converters, args)]
+        except ValueError:
+            return None
 
 
 class StudentBotService:
-    def __init__(self, setup_data: SetupServiceData) -> None:
+    def __init__(self, setup_data: SetupServiceData, concurrent_updates: int = 64) -> None:
         self.logger = setup_data.logger
+        # Updates of different users handled at once, see `PerUserUpdateProcessor`
+        self.concurrent_updates = concurrent_updates
+        self.webhook = setup_data.webhook
         self.clients: dict[int, Client] = dict()
 
-        self.groups = "km31", "km32", "km33"
-        self.admins = Admins(self)
-        self.verification = Verification(self)
+        self.group_registry = load_groups()
+        self.groups = tuple(group.name for group in self.group_registry)
+        # Replayed from their journals in `setup`
+        self.admins: Admins | None = None
+        self.verification: Verification | None = None
         self.student_db = StudentDB()
         self.schedule_db = ScheduleDB(self)
-
-        self.app = ApplicationBuilder().token(get_token("StudentsBot")).build()
+        self.broadcast = Broadcast(self)
+        self.metadata = TelegramMetadata(self)
+        # Every message sent to users goes through it, see `send`
+        self.outbound = OutboundScheduler(self.logger)
+
+        self.app = self.build_app()
+
+    def build_app(self) -> Application:
+        # Pool size is the one ApplicationBuilder uses by default
+        return (ApplicationBuilder().token(get_token("StudentsBot"))
+                .request(MeasuredRequest(connection_pool_size=256))
+                .concurrent_updates(PerUserUpdateProcessor(self.concurrent_updates))
+                .build())
     
+    async def setup(self) -> None:
+        "State, databases and Telegram are set up concurrently, updates are taken once all are ready"
+        self.logger.info("StudentBotService: Starting")
+        timer = StartupTimer()
+
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(timer.time("stores", asyncio.to_thread(self.load_stores)))
+            tg.create_task(timer.time("student_db", self.student_db.open()))
+            tg.create_task(timer.time("schedule", self.load_schedule()))
+            tg.create_task(timer.time("telegram", self.bot_setup()))
+
+        await timer.time("updates", start_updates(self.app, "StudentsBot", self.webhook))
+        self.logger.info(f"StudentBotService: Started in {timer.report()}")
+
     async def run(self) -> None:
-        try:
-            await self.bot_setup()
-            await idle()
-        finally:
-            await self.app.updater.stop()
-            await self.app.stop()
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(idle())
+            tg.create_task(self.outbound.run())
+            tg.create_task(self.report_stats())
+            tg.create_task(self.schedule_db.refresh_periodically())
+            tg.create_task(self.schedule_db.listen())
+            tg.create_task(self.broadcast.run())
+
+    async def shutdown(self) -> None:
+        "Also undoes a `setup` that failed halfway"
+        await stop_updates(self.app, "StudentsBot", self.webhook)
+        if self.app.running:
+            # `run` was cancelled already, updates in flight wait for the scheduler to send their answers
+            draining = asyncio.create_task(self.outbound.run())
+            try:
+                await self.app.stop()
+            finally:
+                draining.cancel()
+        self.outbound.close()
+        await self.app.shutdown()
+        await self.student_db.close()
+        await self.schedule_db.close()
+        if self.admins is not None:
+            self.admins.close()
+        if self.verification is not None:
+            self.verification.close()
+
+    def load_stores(self) -> None:
+        "Blocking, reads the journals"
+        self.admins = Admins(self)
+        self.verification = Verification(self)
 
-    async def bot_setup(self) -> None:
-        self.logger.info("StudentBotService: Starting")
+    async def load_schedule(self) -> None:
+        await self.schedule_db.open()
+        await self.schedule_db.refresh()
+
+    async def report_stats(self, interval: float = 15*60) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            stats = self.student_db.cache.stats()
+            self.logger.info(f"StudentBotService: Student cache {stats['size']}/{stats['maxsize']}, "
+                             f"hit rate {stats['hit_rate']:.1%} ({stats['hits']} hits, {stats['misses']} misses), "
+                             f"{stats['evictions']} evictions, {stats['expirations']} expirations, "
+                             f"{self.student_db.selects_per_update:.2f} SELECT per update")
+            names = self.metadata.names.stats()
+            self.logger.info(f"StudentBotService: Telegram names cache {names['size']}/{names['maxsize']}, "
+                             f"hit rate {names['hit_rate']:.1%} ({names['hits']} hits, {names['misses']} misses)")
+            self.logger.info(f"StudentBotService: Outbound {self.outbound.stats['sent']} sent, "
+                             f"{self.outbound.stats['retried']} retried, {self.outbound.stats['failed']} failed, "
+                             f"{self.outbound.queued()} queued")
 
+    async def bot_setup(self) -> None:
         await self.app.initialize()
         await self.app.start()
 
         await self.set_commands_interface()
         self.set_handlers()
 
-        await self.app.updater.start_polling()
-
     async def set_commands_interface(self) -> None:
         await self.app.bot.set_my_commands([
             telegram.BotCommand(command="/start", description="Start the bot"),
@@ -483,13 +1296,32 @@ class StudentBotService:
         ])
 
     def set_handlers(self) -> None:
-        self.app.add_handler(CommandHandler("start", self.start))
-        self.app.add_handler(CommandHandler("menu", self.menu))
-        self.app.add_handler(CommandHandler("admin", self.self_promote))
-        self.app.add_handler(CallbackQueryHandler(self.button_controller))
+        self.app.add_handler(CommandHandler("start", self.handler(self.start)))
+        self.app.add_handler(CommandHandler("menu", self.handler(self.menu)))
+        self.app.add_handler(CommandHandler("admin", self.handler(self.self_promote)))
+        self.app.add_handler(CallbackQueryHandler(self.handler(self.button_controller)))
         self.app.add_handler(MessageHandler(
-            filters.TEXT & ~filters.COMMAND, self.text_controller))
+            filters.TEXT & ~filters.COMMAND, self.handler(self.text_controller)))
         self.app.add_handler(MessageHandler(filters.ALL, self.user_input_deleter))
+
+    def handler(self, callback):
+        """Remembers Telegram metadata of the update and runs `callback` as a unit of work,
+        so student changes are written once it finishes"""
+        async def wrapper(update: telegram.Update, context: CallbackContext):
+            self.metadata.remember(update)
+            try:
+                with HANDLER_SECONDS.time(handler=callback.__name__):
+                    async with self.student_db.unit_of_work(update_user(update)) as unit_of_work:
+                        result = await callback(update, context)
+            except Exception:
+                HANDLER_ERRORS.inc(handler=callback.__name__)
+                raise
+
+            self.logger.debug(f"StudentBotService: Update {update.update_id} made "
+                              f"{unit_of_work.selects} SELECT and {unit_of_work.updates} UPDATE queries")
+            return result
+
+        return wrapper
     
     async def user_input_deleter(self, update: telegram.Update, context: CallbackContext) -> None:
         await delete_user_request_if_text(update)
@@ -497,25 +1329,28 @@ class StudentBotService:
 
     async def self_promote(self, update: telegram.Update, context: CallbackContext) -> None:
         await delete_user_request_if_text(update)
-        for group in self.groups:
-            self.admins.add_admin(group, update.effective_user.id)
+        await self.admins.add_admin(list(self.groups), update.effective_user.id)
 
     async def button_controller(self, update: telegram.Update, context: CallbackContext) -> None:
         query = update.callback_query
 
-        if not self.student_db.student_exist(query.from_user.id):
+        resolved = ROUTER.resolve(query.data)
+        if resolved is None:
+            self.logger.error(f"Button: {query.data} not found. User: {query.from_user.name} | {query.message.to_json()}")
+            await query.answer(text="Invalid option selected.")
+            return
+
+        route, args = resolved
+        if route.needs_student and not await self.student_db.student_exist(query.from_user.id):
             await query.answer(text="Message is broken :0\nWrite /start to fix this >_<")
             return
 
-        if hasattr(Button, query.data):
-            await getattr(Button, query.data)(self, update, context)
-        else:
-            self.logger.error(f"Button: {query.data} not found. User: {query.from_user.name} | {query.message.to_json()}")
-            await query.answer(text="Invalid option selected.")
+        with BUTTON_SECONDS.time(button=route.name):
+            await route.action(self, update, context, *args)
 
     async def text_controller(self, update: telegram.Update, context: CallbackContext) -> int:
         user = update.effective_user
-        client = self.student_db.get_student(user.id)
+        client = await self.student_db.get_student(user.id)
 
         if client is None or not client.is_inputting_name:
             await update.message.delete()
@@ -529,42 +1364,56 @@ class StudentBotService:
         
         return telegram.ext.ConversationHandler.END
 
-    async def send(self, usr_id: int, text: str, **kwargs) -> int:
+    async def send(self, usr_id: int, text: str, priority: Priority = Priority.INTERACTIVE, **kwargs) -> int:
         "Returns new message's id"
         
-        client = self.student_db.get_student(usr_id)
+        client = await self.student_db.get_student(usr_id)
         main_message_id = client.main_message
 
         if main_message_id is None or not client.is_main_message_first:
-            client.is_main_message_first = True
-            return await self._reset_and_send(usr_id, text, **kwargs)
+            await self.student_db.set_columns(client, {"main_message_first": True})
+            return await self._reset_and_send(usr_id, text, priority, **kwargs)
 
         try:
-            message = await self.app.bot.edit_message_text(text, chat_id=usr_id, message_id=main_message_id, **kwargs)
+            message = await self.outbound.call(
+                usr_id, partial(self.app.bot.edit_message_text, text, chat_id=usr_id, message_id=main_message_id, **kwargs), priority)
             return message.id
         
         except telegram.error.BadRequest:
-            return await self._reset_and_send(usr_id, text, **kwargs)
+            return await self._reset_and_send(usr_id, text, priority, **kwargs)
+
+    async def reply(self, update: telegram.Update, text: str, **kwargs) -> int:
+        """Edits the message whose button was pressed without looking up the student,
+        other updates are answered with `send`. Returns the message's id"""
+        query = update.callback_query
+        if query is None or not isinstance(query.message, telegram.Message):
+            return await self.send(update.effective_user.id, text, **kwargs)
+
+        try:
+            await self.outbound.call(query.from_user.id, partial(query.message.edit_text, text, **kwargs))
+            return query.message.message_id
+        except telegram.error.BadRequest:
+            return await self.send(update.effective_user.id, text, **kwargs)
 
-    async def send_raw(self, usr_id: int, text: str, **kwargs) -> int:
-        message = await self.app.bot.send_message(usr_id, text, **kwargs)
-        client = self.student_db.get_student(usr_id)
-        client.is_main_message_first = False
+    async def send_raw(self, usr_id: int, text: str, priority: Priority = Priority.INTERACTIVE, **kwargs) -> int:
+        message = await self.outbound.call(usr_id, partial(self.app.bot.send_message, usr_id, text, **kwargs), priority)
+        client = await self.student_db.get_student(usr_id)
+        await self.student_db.set_columns(client, {"main_message_first": False})
         return message.id
 
-    async def _reset_and_send(self, usr_id: int, text: str, **kwargs) -> int:
-        new_message = await self.app.bot.send_message(usr_id, text, **kwargs)
+    async def _reset_and_send(self, usr_id: int, text: str, priority: Priority = Priority.INTERACTIVE, **kwargs) -> int:
+        new_message = await self.outbound.call(usr_id, partial(self.app.bot.send_message, usr_id, text, **kwargs), priority)
 
-        await self.clear_main_message(usr_id)
-        client = self.student_db.get_student(usr_id)
-        client.main_message = new_message.id
+        await self.clear_main_message(usr_id, priority)
+        client = await self.student_db.get_student(usr_id)
+        await self.student_db.set_columns(client, {"main_message": new_message.id})
 
         return new_message.id
 
-    async def clear_main_message(self, usr_id: int) -> None:
-        message = self.student_db.get_student(usr_id).main_message
+    async def clear_main_message(self, usr_id: int, priority: Priority = Priority.INTERACTIVE) -> None:
+        message = (await self.student_db.get_student(usr_id)).main_message
         try:
-            await self.app.bot.delete_message(usr_id, message)
+            await self.outbound.call(usr_id, partial(self.app.bot.delete_message, usr_id, message), priority)
         except telegram.error.BadRequest:
             pass
 
@@ -572,7 +1421,7 @@ class StudentBotService:
         await delete_user_request_if_text(update)
 
         usr = update.effective_user
-        client = self.student_db.get_student(usr.id)
+        client = await self.student_db.get_student(usr.id)
 
         if client is None:
             return
@@ -586,7 +1435,7 @@ class StudentBotService:
     async def start(self, update: telegram.Update, context: CallbackContext) -> None:
         user = update.effective_user
 
-        if self.student_db.student_exist(user.id) and self.student_db.get_student(user.id).is_verified:
+        if await self.student_db.student_exist(user.id) and (await self.student_db.get_student(user.id)).is_verified:
             await self.menu(update, context)
             return
 
@@ -595,30 +1444,27 @@ class StudentBotService:
         await delete_user_request_if_text(update)
         await self.init_user(user.id)
 
-        if await update.effective_chat.get_member_count() > 2:
+        if await self.metadata.member_count(update.effective_chat) > 2:
             # TODO make it work in groups
-            await update.message.reply_text("Cannot be used in groups yet. Sorry!")
+            await self.outbound.call(update.effective_chat.id, partial(update.message.reply_text, "Cannot be used in groups yet. Sorry!"))
         else:
             await Menu.group_choice_menu(self, update, context)
 
     async def init_user(self, usr_id: int) -> None:
-        if self.student_db.student_exist(usr_id):
+        if await self.student_db.student_exist(usr_id):
             return
         
-        self.student_db.add_student(usr_id)
+        await self.student_db.add_student(usr_id)
 
     async def get_name_by_id(self, usr_id: int) -> str:
-        user = await self.app.bot.get_chat_member(usr_id, usr_id)
-        return user.user.name
+        return await self.metadata.name(usr_id)
 
 
 class Menu:
     @staticmethod
     async def group_choice_menu(service: StudentBotService, update: telegram.Update, context: CallbackContext) -> None:
         reply_markup = telegram.InlineKeyboardMarkup([
-            [InlineKeyboardButton("Km-31", callback_data="group_31")],
-            [InlineKeyboardButton("Km-32", callback_data="group_32")],
-            [InlineKeyboardButton("Km-33", callback_data="group_33")],
+            *([InlineKeyboardButton(group.title, callback_data=f"group:{group.name}")] for group in service.group_registry),
             [InlineKeyboardButton("Not a student", callback_data="group_none")],
         ])
         await service.send(update.effective_user.id, "Choose your group:", reply_markup=reply_markup)
@@ -627,7 +1473,7 @@ class Menu:
     async def enter_name_menu(service: StudentBotService, update: telegram.Update, context: CallbackContext) -> None:
         query = update.callback_query
         await service.send(update.effective_user.id, "Enter your full name:")
-        client = service.student_db.get_student(query.from_user.id)
+        client = await service.student_db.get_student(query.from_user.id)
         client.is_inputting_name = True
         
     @staticmethod
@@ -646,26 +1492,26 @@ class Menu:
             [InlineKeyboardButton("Register", callback_data="restart")],
             [InlineKeyboardButton("Options", callback_data="options")],
         ])
-        await service.send(update.effective_user.id, "You are not registered", reply_markup=reply_markup)
+        await service.reply(update, "You are not registered", reply_markup=reply_markup)
 
     @staticmethod
     async def schedule_menu(service: StudentBotService, update: telegram.Update, context: CallbackContext) -> None:
         reply_markup = telegram.InlineKeyboardMarkup([
-            [InlineKeyboardButton("Понеділок", callback_data="schedule_mon")],
-            [InlineKeyboardButton("Вівторок", callback_data="schedule_tue")],
-            [InlineKeyboardButton("Середа", callback_data="schedule_wed")],
-            [InlineKeyboardButton("Четвер", callback_data="schedule_thu")],
-            [InlineKeyboardButton("П'ятниця", callback_data="schedule_fri")]
+            [InlineKeyboardButton("Сьогодні", callback_data="schedule:today"),
+             InlineKeyboardButton("Завтра", callback_data="schedule:tomorrow")],
+            [InlineKeyboardButton("Тиждень", callback_data="week")],
+            # The menu stays in the chat for days, the week is the one of the tap
+            *([InlineKeyboardButton(title, callback_data=f"schedule:{day}")] for day, title in DAY_TITLES.items()),
         ])
-        await service.send(update.effective_user.id, "Enter the day:", reply_markup=reply_markup)
+        await service.reply(update, "Enter the day:", reply_markup=reply_markup)
 
     @staticmethod
     async def options_menu(service: StudentBotService, update: telegram.Update, context: CallbackContext) -> None:
-        await service.send(update.effective_user.id, "<Options>")
+        await service.reply(update, "<Options>")
 
     @staticmethod
     async def main_menu(service: StudentBotService, update: telegram.Update, context: CallbackContext) -> None:
-        user = service.student_db.get_student(update.effective_user.id)
+        user = await service.student_db.get_student(update.effective_user.id)
 
         reply_markup = telegram.InlineKeyboardMarkup([
             [InlineKeyboardButton("Schedule", callback_data="schedule")],
@@ -678,26 +1524,14 @@ class Menu:
 
 class Button:
     @staticmethod
-    async def group_31(service: StudentBotService, update: telegram.Update, context: CallbackContext) -> None:
+    async def group(service: StudentBotService, update: telegram.Update, context: CallbackContext, group: str) -> None:
         query = update.callback_query
-        client = service.student_db.get_student(query.from_user.id)
-        client.group = "km31"
-        await query.answer()
-        await Menu.enter_name_menu(service, update, context)
+        if group not in service.groups:
+            await query.answer(text="Unknown group.")
+            return
 
-    @staticmethod
-    async def group_32(service: StudentBotService, update: telegram.Update, context: CallbackContext) -> None:
-        query = update.callback_query
-        client = service.student_db.get_student(query.from_user.id)
-        client.group = "km32"
-        await query.answer()
-        await Menu.enter_name_menu(service, update, context)
-
-    @staticmethod
-    async def group_33(service: StudentBotService, update: telegram.Update, context: CallbackContext) -> None:
-        query = update.callback_query
-        client = service.student_db.get_student(query.from_user.id)
-        client.group = "km33"
+        client = await service.student_db.get_student(query.from_user.id)
+        client.group = group
         await query.answer()
         await Menu.enter_name_menu(service, update, context)
 
@@ -726,40 +1560,22 @@ class Button:
         await Menu.schedule_menu(service, update, context)
 
     @staticmethod
-    async def schedule_mon(service: StudentBotService, update: telegram.Update, context: CallbackContext) -> None:
-        query = update.callback_query
-        user_id = query.from_user.id
-        await query.answer()
-        await service.schedule_db.send_schedule(update, user_id, context, 'Monday')
-
-    @staticmethod
-    async def schedule_tue(service: StudentBotService, update: telegram.Update, context: CallbackContext) -> None:
-        query = update.callback_query
-        user_id = query.from_user.id
-        await query.answer()
-        await service.schedule_db.send_schedule(update, user_id, context, 'Tuesday')
-
-    @staticmethod
-    async def schedule_wed(service: StudentBotService, update: telegram.Update, context: CallbackContext) -> None:
+    async def schedule_day(service: StudentBotService, update: telegram.Update, context: CallbackContext,
+                           day: str, week: int | None = None) -> None:
+        "`day` is a weekday, today or tomorrow"
         query = update.callback_query
-        user_id = query.from_user.id
         await query.answer()
-        await service.schedule_db.send_schedule(update, user_id, context, 'Wednesday')
+        if day in RELATIVE_DAYS:
+            date = datetime.date.today() + datetime.timedelta(days=RELATIVE_DAYS[day])
+            day, week = WEEKDAYS[date.weekday()], service.schedule_db.get_week(date)
+        await service.schedule_db.send_schedule(update, query.from_user.id, context, day, week)
 
     @staticmethod
-    async def schedule_thu(service: StudentBotService, update: telegram.Update, context: CallbackContext) -> None:
+    async def schedule_week(service: StudentBotService, update: telegram.Update, context: CallbackContext,
+                            week: int | None = None) -> None:
         query = update.callback_query
-        user_id = query.from_user.id
         await query.answer()
-        await service.schedule_db.send_schedule(update, user_id, context, 'Thursday')
-
-    @staticmethod
-    async def schedule_fri(service: StudentBotService, update: telegram.Update, context: CallbackContext) -> None:
-        query = update.callback_query
-        user_id = query.from_user.id
-        await query.answer()
-        await service.schedule_db.send_schedule(update, user_id, context, 'Friday')
-
+        await service.schedule_db.send_week(update, week)
 
     @staticmethod
     async def options(service: StudentBotService, update: telegram.Update, context: CallbackContext) -> None:
@@ -772,7 +1588,7 @@ class Button:
         query = update.callback_query
         await query.answer()
         await service.send(update.effective_user.id, "Verification request sent! Please wait for confirmation ^^")
-        client = service.student_db.get_student(query.from_user.id)
+        client = await service.student_db.get_student(query.from_user.id)
         await service.verification.send(client)
 
         service.logger.info(f"StudentBotService: {query.from_user.name} sent verification request")
@@ -782,8 +1598,8 @@ class Button:
         query = update.callback_query
         await query.answer()
 
-        verifier = service.student_db.get_student(query.from_user.id)
-        client = service.verification.get_client_from_verification_message(query.message)
+        verifier = await service.student_db.get_student(query.from_user.id)
+        client = await service.verification.get_client_from_verification_message(query.message)
         await service.verification.verify(client, verifier)
 
     @staticmethod
@@ -791,8 +1607,8 @@ class Button:
         query = update.callback_query
         await query.answer()
 
-        verifier = service.student_db.get_student(query.from_user.id)
-        client = service.verification.get_client_from_verification_message(query.message)
+        verifier = await service.student_db.get_student(query.from_user.id)
+        client = await service.verification.get_client_from_verification_message(query.message)
         await service.verification.discard(client, verifier)
 
     @staticmethod
@@ -805,10 +1621,33 @@ class Button:
     async def materials(service: StudentBotService, update: telegram.Update, context: CallbackContext) -> None:
         query = update.callback_query
         await query.answer()
-        await service.send(update.effective_user.id, "<Materials>")
+        await service.reply(update, "<Materials>")
     
     @staticmethod
     async def debts(service: StudentBotService, update: telegram.Update, context: CallbackContext) -> None:
         query = update.callback_query
         await query.answer()
-        await service.send(update.effective_user.id, "<Debts>")
+        await service.reply(update, "<Debts>")
+
+
+ROUTER = CallbackRouter([
+    Route("group", Button.group),
+    Route("group_none", Button.group_none, needs_student=False),
+    Route("restart", Button.restart, needs_student=False),
+    Route("not_a_student", Button.not_a_student, needs_student=False),
+    Route("schedule", Button.schedule, needs_student=False),
+    Route("schedule", Button.schedule_day),
+    Route("week", Button.schedule_week),
+    Route("options", Button.options, needs_student=False),
+    Route("confirm", Button.confirm),
+    Route("verify_user", Button.verify_user),
+    Route("discard_user", Button.discard_user),
+    Route("menu", Button.menu),
+    Route("materials", Button.materials, needs_student=False),
+    Route("debts", Button.debts, needs_student=False),
+], aliases={
+    "group_31": "group:km31",
+    "group_32": "group:km32",
+    "group_33": "group:km33",
+    **{f"schedule_{day[:3].lower()}": f"schedule:{day}" for day in WEEKDAYS[:5]},
+})
@@ -0,0 +1,132 @@
+import asyncio
+import hmac
+import json
+import logging
+import secrets
+from collections import Counter
+from http import HTTPStatus
+
+import telegram
+from telegram.ext import Application
+
+from service_setup import UpdatesConfig
+
+
+class WebhookServer:
+    """Receives updates of every bot on one port, Telegram posts them to `<url>/<bot name>`.
+    Requests without the bot's secret token are rejected, accepted updates are put
+    into the bot's update queue the same way polling does"""
+    # Telegram's updates are far smaller
+    MAX_BODY = 1 << 20
+
+    def __init__(self, config: UpdatesConfig, logger: logging.Logger) -> None:
+        self.config = config
+        self.logger = logger
+        # Bot name: (application, secret token)
+        self._bots: dict[str, tuple[Application, str]] = {}
+        self._server: asyncio.Server | None = None
+        # Totals of "accepted", "rejected" and "invalid" requests
+        self.stats = Counter()
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._serve, self.config.listen, self.config.port)
+        self.logger.info(f"Webhook: Listening on {self.config.listen}:{self.config.port}")
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def register(self, name: str, app: Application) -> None:
+        "Routes updates posted to `name` to `app` and tells Telegram to send them there"
+        secret = self.config.secret_token or secrets.token_urlsafe(32)
+        self._bots[name] = (app, secret)
+        await app.bot.set_webhook(f"{self.config.url.rstrip('/')}/{name}", secret_token=secret,
+                                  allowed_updates=telegram.Update.ALL_TYPES)
+        self.logger.info(f"Webhook: Registered {name}")
+
+    async def unregister(self, name: str) -> None:
+        "Telegram keeps updates until the bot polls or registers again"
+        bot = self._bots.pop(name, None)
+        if bot is None:
+            # Stopped before it finished starting
+            return
+        await bot[0].bot.delete_webhook()
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        "HTTP/1.1 with keep-alive, Telegram reuses its connections"
+        try:
+            while request_line := await reader.readline():
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get("content-length", 0))
+                if length > self.MAX_BODY:
+                    self._respond(writer, HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+                    break
+
+                status = await self._handle(method, path, headers, await reader.readexactly(length))
+                self._respond(writer, status)
+                await writer.drain()
+
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError) as e:
+            self.logger.debug(f"Webhook: Dropped connection: {e!r}")
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _respond(writer: asyncio.StreamWriter, status: HTTPStatus) -> None:
+        writer.write(f"HTTP/1.1 {status.value} {status.phrase}\r\nContent-Length: 0\r\n\r\n".encode())
+
+    async def _handle(self, method: str, path: str, headers: dict[str, str], body: bytes) -> HTTPStatus:
+        bot = self._bots.get(path.strip("/"))
+        if bot is None:
+            return HTTPStatus.NOT_FOUND
+        if method != "POST":
+            return HTTPStatus.METHOD_NOT_ALLOWED
+
+        app, secret = bot
+        token = headers.get("x-telegram-bot-api-secret-token", "")
+        if not hmac.compare_digest(token.encode(), secret.encode()):
+            self.stats["rejected"] += 1
+            self.logger.warning(f"Webhook: Rejected update for {path} with a wrong secret token")
+            return HTTPStatus.FORBIDDEN
+
+        try:
+            payload = json.loads(body)
+            if not isinstance(payload, dict):
+                raise TypeError(f"Expected an object, got {type(payload).__name__}")
+            # Empty objects decode to None
+            update = telegram.Update.de_json(payload, app.bot)
+            if update is None:
+                raise ValueError("Empty update")
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            self.stats["invalid"] += 1
+            self.logger.warning(f"Webhook: Invalid update for {path}: {e!r}")
+            return HTTPStatus.BAD_REQUEST
+
+        self.stats["accepted"] += 1
+        await app.update_queue.put(update)
+        return HTTPStatus.OK
+
+
+async def start_updates(app: Application, name: str, webhook: WebhookServer | None) -> None:
+    "Polls for updates of `app`, or registers it to `webhook` when there is one"
+    if webhook is None:
+        await app.updater.start_polling()
+    else:
+        await webhook.register(name, app)
+
+
+async def stop_updates(app: Application, name: str, webhook: WebhookServer | None) -> None:
+    if webhook is None:
+        if app.updater.running:
+            await app.updater.stop()
+    else:
+        await webhook.unregister(name)
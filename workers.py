@@ -0,0 +1,121 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import sys
+from dataclasses import dataclass
+from logging.handlers import QueueListener
+from typing import Callable
+
+import metrics
+from logging_setup import RecordQueueHandler
+
+WORKERS = './data/workers.json'
+
+WORKER_RESTARTS = metrics.Counter("worker_restarts_total", "Worker processes started again after they exited", ("worker",))
+
+
+@dataclass(frozen=True)
+class WorkersConfig:
+    # Runs ScheduleDataFetcherService in a supervised process next to the bots
+    schedule_fetcher: bool = False
+    # Seconds before a worker that exited is started again, doubled for every exit in a row
+    restart_delay: float = 1
+    max_restart_delay: float = 60
+
+
+def load_workers_config(filename=WORKERS) -> WorkersConfig:
+    try:
+        with open(filename, 'r') as f:
+            return WorkersConfig(**json.load(f))
+    except FileNotFoundError:
+        return WorkersConfig()
+
+
+class _Forward(logging.Handler):
+    "Hands records of worker processes to the loggers of this process"
+    def emit(self, record: logging.LogRecord) -> None:
+        logger = logging.getLogger(record.name)
+        if logger.isEnabledFor(record.levelno):
+            logger.handle(record)
+
+
+def _worker_main(target: Callable[[logging.Logger], None], log_queue: multiprocessing.Queue, level: int) -> None:
+    "Entry point of worker processes, records are written by the parent"
+    logger = logging.getLogger()
+    logger.setLevel(level)
+    # Handlers set up while the parent's main module was imported again would write twice
+    logger.handlers = [RecordQueueHandler(log_queue)]
+    try:
+        target(logger)
+    except KeyboardInterrupt:
+        # Ctrl+C reaches the whole process group, the parent stops workers itself
+        pass
+    except Exception as e:
+        logger.exception(f"Workers: {multiprocessing.current_process().name} failed: {e}")
+        sys.exit(1)
+
+
+class WorkerProcess:
+    """Runs `target(logger)` in its own process, so blocking work there can't stall the
+    event loop of the bots. The process is started again whenever it exits and is
+    stopped when `run` is cancelled. `target` has to be importable, processes are spawned"""
+    # Seconds between checks whether the process is alive
+    POLL_INTERVAL = 1
+    # Process that ran that long is healthy, the restart delay starts over
+    HEALTHY_AFTER = 60
+    STOP_TIMEOUT = 10
+
+    def __init__(self, name: str, target: Callable[[logging.Logger], None], logger: logging.Logger,
+                 restart_delay: float = 1, max_restart_delay: float = 60) -> None:
+        self.name = name
+        self.target = target
+        self.logger = logger
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        # Same on every platform, forking a process with running threads isn't safe
+        self._context = multiprocessing.get_context("spawn")
+        self._log_queue = self._context.Queue()
+        self.restarts = 0
+
+    async def run(self) -> None:
+        listener = QueueListener(self._log_queue, _Forward())
+        listener.start()
+        loop = asyncio.get_running_loop()
+        delay = self.restart_delay
+
+        try:
+            while True:
+                process = self._context.Process(
+                    target=_worker_main, name=self.name,
+                    args=(self.target, self._log_queue, logging.getLogger().getEffectiveLevel()))
+                # Spawning takes milliseconds, the bots keep answering meanwhile
+                await asyncio.to_thread(process.start)
+                started = loop.time()
+                self.logger.info(f"Workers: Started {self.name} (pid {process.pid})")
+
+                try:
+                    while process.is_alive():
+                        await asyncio.sleep(self.POLL_INTERVAL)
+                finally:
+                    if process.is_alive():
+                        await asyncio.to_thread(self._stop, process)
+
+                if loop.time() - started >= self.HEALTHY_AFTER:
+                    delay = self.restart_delay
+                self.restarts += 1
+                WORKER_RESTARTS.inc(worker=self.name)
+                self.logger.error(f"Workers: {self.name} exited with code {process.exitcode}, restarting in {delay}s")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_restart_delay)
+        finally:
+            listener.stop()
+
+    def _stop(self, process: multiprocessing.Process) -> None:
+        process.terminate()
+        process.join(self.STOP_TIMEOUT)
+        if process.is_alive():
+            self.logger.warning(f"Workers: {self.name} didn't stop in {self.STOP_TIMEOUT}s, killing it")
+            process.kill()
+            process.join()
+        self.logger.info(f"Workers: Stopped {self.name}")